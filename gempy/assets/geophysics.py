@@ -15,11 +15,15 @@
     along with gempy.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import itertools
 import numpy as np
-import theano
-import theano.tensor as T
 from gempy.core.grid_modules.grid_types import CenteredGrid
 
+# Sign of each voxel corner for the gravity (tz) and magnetic (V) volume integrals, in the
+# itertools.product(x_cor, y_cor, z_cor) order of the kernels. Depends on your coordinate system
+_TZ_CORNER_SIGNS = (1, -1, -1, 1, -1, 1, 1, -1)
+_V_CORNER_SIGNS = (-1, 1, 1, -1, 1, -1, -1, 1)
+
 
 class GravityPreprocessing(CenteredGrid):
     def __init__(self, centered_grid: CenteredGrid = None):
@@ -43,19 +47,9 @@ class GravityPreprocessing(CenteredGrid):
         s_gr_z = grid_values[:, 2]
 
         # getting the coordinates of the corners of the voxel...
-        x_cor = np.stack((s_gr_x - self.kernel_dxyz_left[:, 0], s_gr_x + self.kernel_dxyz_right[:, 0]), axis=1)
-        y_cor = np.stack((s_gr_y - self.kernel_dxyz_left[:, 1], s_gr_y + self.kernel_dxyz_right[:, 1]), axis=1)
-        z_cor = np.stack((s_gr_z - self.kernel_dxyz_left[:, 2], s_gr_z + self.kernel_dxyz_right[:, 2]), axis=1)
-
-        # ...and prepare them for a vectorial op
-        x_matrix = np.repeat(x_cor, 4, axis=1)
-        y_matrix = np.tile(np.repeat(y_cor, 2, axis=1), (1, 2))
-        z_matrix = np.tile(z_cor, (1, 4))
-
-        s_r = np.sqrt(x_matrix ** 2 + y_matrix ** 2 + z_matrix ** 2)
-
-        # This is the vector that determines the sign of the corner of the voxel
-        mu = np.array([1, -1, -1, 1, -1, 1, 1, -1])
+        x_cor = (s_gr_x - self.kernel_dxyz_left[:, 0], s_gr_x + self.kernel_dxyz_right[:, 0])
+        y_cor = (s_gr_y - self.kernel_dxyz_left[:, 1], s_gr_y + self.kernel_dxyz_right[:, 1])
+        z_cor = (s_gr_z - self.kernel_dxyz_left[:, 2], s_gr_z + self.kernel_dxyz_right[:, 2])
 
         if scale is True:
             #
@@ -63,14 +57,15 @@ class GravityPreprocessing(CenteredGrid):
         else:
             from scipy.constants import G
 
-        self.tz = (
-            G *
-            np.sum(- 1 *
-                   mu * (
-                           x_matrix * np.log(y_matrix + s_r) +
-                           y_matrix * np.log(x_matrix + s_r) -
-                           z_matrix * np.arctan(x_matrix * y_matrix / (z_matrix * s_r))),
-                   axis=1))
+        # ...and add up the 8 corners one at a time instead of materializing (n, 8) matrices
+        tz = np.zeros(grid_values.shape[0])
+        for mu, (x, y, z) in zip(_TZ_CORNER_SIGNS, itertools.product(x_cor, y_cor, z_cor)):
+            s_r = np.sqrt(x ** 2 + y ** 2 + z ** 2)
+            tz -= mu * (x * np.log(y + s_r) +
+                        y * np.log(x + s_r) -
+                        z * np.arctan(x * y / (z * s_r)))
+
+        self.tz = G * tz
 
         return self.tz
 
@@ -100,25 +95,21 @@ class MagneticsPreprocessing(CenteredGrid):
         s_gr_z = -1 * grid_values[:, 2]  # talwani takes x-axis positive downwards, and gempy negative downwards
 
         # getting the coordinates of the corners of the voxel...
-        x_cor = np.stack((s_gr_x - self.kernel_dxyz_left[:, 0], s_gr_x + self.kernel_dxyz_right[:, 0]), axis=1)
-        y_cor = np.stack((s_gr_y - self.kernel_dxyz_left[:, 1], s_gr_y + self.kernel_dxyz_right[:, 1]), axis=1)
-        z_cor = np.stack((s_gr_z + self.kernel_dxyz_left[:, 2], s_gr_z - self.kernel_dxyz_right[:, 2]), axis=1)
-        # ...and prepare them for a vectorial op
-        x_matrix = np.repeat(x_cor, 4, axis=1)
-        y_matrix = np.tile(np.repeat(y_cor, 2, axis=1), (1, 2))
-        z_matrix = np.tile(z_cor, (1, 4))
-
-        R = np.sqrt(x_matrix ** 2 + y_matrix ** 2 + z_matrix ** 2)  # distance to each corner
-        s = np.array([-1, 1, 1, -1, 1, -1, -1, 1])  # gives the sign of each corner: depends on your coordinate system
-
-        # variables V1-6 represent integrals of volume for each voxel
-        V1 = np.sum(-1 * s * np.arctan2((y_matrix * z_matrix), (x_matrix * R)), axis=1)
-        V2 = np.sum(s * np.log(R + z_matrix), axis=1)
-        V3 = np.sum(s * np.log(R + y_matrix), axis=1)
-        V4 = np.sum(-1 * s * np.arctan2((x_matrix * z_matrix), (y_matrix * R)), axis=1)
-        V5 = np.sum(s * np.log(R + x_matrix), axis=1)
-        V6 = np.sum(-1 * s * np.arctan2((x_matrix * y_matrix), (z_matrix * R)), axis=1)
+        x_cor = (s_gr_x - self.kernel_dxyz_left[:, 0], s_gr_x + self.kernel_dxyz_right[:, 0])
+        y_cor = (s_gr_y - self.kernel_dxyz_left[:, 1], s_gr_y + self.kernel_dxyz_right[:, 1])
+        z_cor = (s_gr_z + self.kernel_dxyz_left[:, 2], s_gr_z - self.kernel_dxyz_right[:, 2])
+
+        # variables V1-6 represent integrals of volume for each voxel. They are accumulated
+        # corner by corner instead of on (n, 8) repeated/tiled corner matrices
+        V = np.zeros((6, grid_values.shape[0]))
+        for s, (x, y, z) in zip(_V_CORNER_SIGNS, itertools.product(x_cor, y_cor, z_cor)):
+            R = np.sqrt(x ** 2 + y ** 2 + z ** 2)  # distance to each corner
+            V[0] -= s * np.arctan2((y * z), (x * R))
+            V[1] += s * np.log(R + z)
+            V[2] += s * np.log(R + y)
+            V[3] -= s * np.arctan2((x * z), (y * R))
+            V[4] += s * np.log(R + x)
+            V[5] -= s * np.arctan2((x * y), (z * R))
 
         # contains all the volume integrals (6 x n_kernelvalues)
-        V = np.array([V1, V2, V3, V4, V5, V6])
         return V
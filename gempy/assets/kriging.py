@@ -8,14 +8,15 @@ Created on 07.08.2019
 
 import warnings
 try:
-    from scipy.spatial.distance import cdist
+    from scipy.spatial.distance import cdist, pdist, squareform
+    from scipy.spatial import cKDTree
+    from scipy.linalg import cho_factor, cho_solve
 except ImportError:
-    warnings.warn('scipy.spatial package is not installed.')
+    warnings.warn('scipy.spatial or scipy.linalg package is not installed.')
 
 import numpy as np
 import pandas as pd
 from gempy.plot import _visualization_2d, _plot, helpers
-import matplotlib.cm as cm
 import matplotlib.pyplot as plt
 from copy import deepcopy
 
@@ -42,10 +43,10 @@ class domain(object):
         # basic statistics of data
         # TODO: allow to set this  for SK ???
         if set_mean is None:
-            set_mean = np.mean(data[:, 3])
+            set_mean = np.mean(self.values)
         self.inp_mean = set_mean
 
-        self.inp_var = np.var(data[:, 3])
+        self.inp_var = np.var(self.values)
         self.inp_std = np.sqrt(self.inp_var)
 
     def set_domain(self, domain):
@@ -68,6 +69,11 @@ class domain(object):
         self.krig_lith = self.sol.lith_block[self.mask]
         self.krig_grid = self.sol.grid.values[self.mask]
 
+        # flat indices of the domain cells and regular grid geometry, for mapping results back onto the grid
+        self.mask_idx = np.flatnonzero(self.mask)
+        self.resolution = self.sol.grid.regular_grid.resolution
+        self.extent = self.sol.grid.regular_grid.extent
+
     def set_data(self, data):
         """
         Method to set input data from csv or numpy array.
@@ -80,9 +86,16 @@ class domain(object):
         # set domain to variable of class
         self.data = data
 
-        # create dataframe of input data for calling
-        d = {'X': data[:, 0], 'Y': data[:, 1], 'Z': data[:, 2], 'property': data[:, 3]}
-        self.data_df = pd.DataFrame(data=d)
+        # contiguous copies of coordinates and property values, so that the distance and kriging
+        # computations do not work on strided views of data
+        self.coords = np.ascontiguousarray(data[:, :3])
+        self.values = np.ascontiguousarray(data[:, 3])
+
+    @property
+    def data_df(self):
+        """Dataframe of the input data, created when it is called"""
+        d = {'X': self.coords[:, 0], 'Y': self.coords[:, 1], 'Z': self.coords[:, 2], 'property': self.values}
+        return pd.DataFrame(data=d)
 
 
 class variogram_model(object):
@@ -100,29 +113,31 @@ class variogram_model(object):
         self.sill = sill
         self.nugget = nugget
 
-    def calculate_semivariance(self, d):
+    @property
+    def theoretical_model(self):
+        return self._theoretical_model
+
+    @theoretical_model.setter
+    def theoretical_model(self, theoretical_model):
+        # bind the model functions once here instead of comparing strings on every evaluation
+        semivariance_functions = {'exponential': self.exponential_variogram_model,
+                                  'gaussian': self.gaussian_variogram_model,
+                                  'spherical': self.spherical_variogram_model}
+        covariance_functions = {'exponential': self.exponential_covariance_model,
+                                'gaussian': self.gaussian_covariance_model,
+                                'spherical': self.spherical_covariance_model}
+        if theoretical_model not in semivariance_functions:
+            raise ValueError('theoretical variogram model not understood')
+
+        self._theoretical_model = theoretical_model
+        self._semivariance_function = semivariance_functions[theoretical_model]
+        self._covariance_function = covariance_functions[theoretical_model]
 
-        if self.theoretical_model == 'exponential':
-            gamma = self.exponential_variogram_model(d)
-        elif self.theoretical_model == 'gaussian':
-            gamma = self.gaussian_variogram_model(d)
-        elif self.theoretical_model == 'spherical':
-            gamma = self.spherical_variogram_model(d)
-        else:
-            print('theoretical varigoram model not understood')
-        return gamma
+    def calculate_semivariance(self, d):
+        return self._semivariance_function(d)
 
     def calculate_covariance(self, d):
-
-        if self.theoretical_model == 'exponential':
-            gamma = self.exponential_covariance_model(d)
-        elif self.theoretical_model == 'gaussian':
-            gamma = self.gaussian_covariance_model(d)
-        elif self.theoretical_model == 'spherical':
-            gamma = self.spherical_covariance_model(d)
-        else:
-            print('theoretical varigoram model not understood')
-        return gamma
+        return self._covariance_function(d)
 
     # TODO: Add more options
     # seems better now by changing psill in covariance model
@@ -155,23 +170,17 @@ class variogram_model(object):
     def spherical_variogram_model(self, d):
         '''Spherical variogram model, effective range equals range parameter, valid in R3'''
         psill = self.sill - self.nugget
-        d = d.astype(float)
-        gamma = np.piecewise(d, [d <= self.range_, d > self.range_],
-                             [lambda d:
-                              psill * ((3. * d) / (2. * self.range_)
-                                       - (d ** 3.) / (2. * self.range_ ** 3.)) + self.nugget,
-                              lambda d: self.sill])
+        # distances beyond the range are clipped to it, where the polynomial reaches the sill
+        t = np.minimum(d, self.range_) / self.range_
+        gamma = psill * t * (1.5 - 0.5 * t * t) + self.nugget
         return gamma
 
     def spherical_covariance_model(self, d):
         '''Spherical covariance model, effective range equals range parameter, valid in R3'''
         psill = self.sill - self.nugget
-        d = d.astype(float)
-        gamma = np.piecewise(d, [d <= self.range_, d > self.range_],
-                             [lambda d:
-                              psill * (1 - ((3. * d) / (2. * self.range_)
-                                            - (d ** 3.) / (2. * self.range_ ** 3.))),
-                              lambda d: 0])
+        # distances beyond the range are clipped to it, where the covariance reaches 0
+        t = np.minimum(d, self.range_) / self.range_
+        gamma = psill * (1 - t * (1.5 - 0.5 * t * t))
         return gamma
 
     # TODO: Make this better and nicer and everything
@@ -217,11 +226,16 @@ class field_solution(object):
 
     def __init__(self, domain, variogram_model, results, field_type):
 
-        self.results_df = results
+        self.results = results
         self.variogram_model = deepcopy(variogram_model)
         self.domain = deepcopy(domain)
         self.field_type = field_type
 
+    @property
+    def results_df(self):
+        """Dataframe of the results, created when it is called"""
+        return pd.DataFrame(data=self.results)
+
     def plot_results(self, geo_data, prop='val', direction='y', result='interpolation', cell_number=0, contour=False,
                      cmap='viridis', alpha=0, legend=False, interpolation='nearest', show_data=True):
         """
@@ -240,45 +254,48 @@ class field_solution(object):
 
         """
         a = np.full_like(self.domain.mask, np.nan, dtype=np.double) #array like lith_block but with nan if outside domain
+        mask_idx = self.domain.mask_idx
 
-        est_vals = self.results_df['estimated value'].values
-        est_var = self.results_df['estimation variance'].values
+        est_vals = self.results['estimated value']
+        est_var = self.results['estimation variance']
 
         # set values
         if prop == 'val':
-            a[np.where(self.domain.mask == True)] = est_vals
+            a.flat[mask_idx] = est_vals
         elif prop == 'var':
-            a[np.where(self.domain.mask == True)] = est_var
+            a.flat[mask_idx] = est_var
         elif prop == 'both':
-            a[np.where(self.domain.mask == True)] = est_vals
+            a.flat[mask_idx] = est_vals
             b = np.full_like(self.domain.mask, np.nan, dtype=np.double)
-            b[np.where(self.domain.mask == True)] = est_var
+            b.flat[mask_idx] = est_var
         else:
             print('prop must be val var or both')
 
         #create plot object
         p = _visualization_2d.PlotSolution(geo_data)
         _a, _b, _c, extent_val, x, y = p._slice(direction, cell_number)[:-2]
+        resolution = self.domain.resolution
 
         #colors
-        cmap = cm.get_cmap(cmap)
+        cmap = plt.get_cmap(cmap)
         cmap.set_bad(color='w', alpha=alpha) #define color and alpha for nan values
 
         # plot
-        if prop is not 'both':
+        if prop != 'both':
             if show_data:
-                plt.scatter(self.domain.data_df[x].values, self.domain.data_df[y].values, marker='*', s=9, c='k')
+                data_df = self.domain.data_df
+                plt.scatter(data_df[x].values, data_df[y].values, marker='*', s=9, c='k')
 
             _plot.plot_section(geo_data, direction=direction, cell_number=cell_number)
             if contour == True:
-                im = plt.contourf(a.reshape(self.domain.sol.grid.regular_grid.resolution)[_a, _b, _c].T, cmap=cmap,
+                im = plt.contourf(a.reshape(resolution)[_a, _b, _c].T, cmap=cmap,
                                   origin='lower', levels=25,
                                   extent=extent_val, interpolation=interpolation)
                 if legend:
                     ax = plt.gca()
                     helpers.add_colorbar(axes=ax, label='prop', cs=im)
             else:
-                im = plt.imshow(a.reshape(self.domain.sol.grid.regular_grid.resolution)[_a, _b, _c].T, cmap=cmap,
+                im = plt.imshow(a.reshape(resolution)[_a, _b, _c].T, cmap=cmap,
                                 origin='lower',
                                 extent=extent_val, interpolation=interpolation)
                 if legend:
@@ -287,17 +304,36 @@ class field_solution(object):
         else:
             f, ax = plt.subplots(1, 2, sharex=True, sharey=True)
             ax[0].title.set_text('Estimated value')
-            im1 = ax[0].imshow(a.reshape(self.domain.sol.grid.regular_grid.resolution)[_a, _b, _c].T, cmap=cmap,
+            im1 = ax[0].imshow(a.reshape(resolution)[_a, _b, _c].T, cmap=cmap,
                                origin='lower', interpolation=interpolation,
-                               extent=self.domain.sol.grid.regular_grid.extent[[0, 1, 4, 5]])
+                               extent=self.domain.extent[[0, 1, 4, 5]])
             helpers.add_colorbar(im1, label='property value')
             ax[1].title.set_text('Variance')
-            im2 = ax[1].imshow(b.reshape(self.domain.sol.grid.regular_grid.resolution)[_a, _b, _c].T, cmap=cmap,
+            im2 = ax[1].imshow(b.reshape(resolution)[_a, _b, _c].T, cmap=cmap,
                                origin='lower', interpolation=interpolation,
-                               extent=self.domain.sol.grid.regular_grid.extent[[0, 1, 4, 5]])
+                               extent=self.domain.extent[[0, 1, 4, 5]])
             helpers.add_colorbar(im2, label='variance[]')
             plt.tight_layout()
 
+def solve_covariance_system(C, c):
+    '''
+    Solve the simple kriging equations. The covariance matrix is symmetric positive definite, so a Cholesky
+    factorization is used, with LU as fallback for matrices that are only semi-definite numerically
+    (e.g. gaussian model without nugget or duplicated locations).
+    Args:
+        C (np.array): covariance matrix between locations in moving neighbourhood
+        c (np.array): covariance vector (or matrix, one column per target) between neighbourhood and target
+    Returns:
+        w (np.array): kriging weights
+    '''
+    if C.shape[0] == 0:
+        # empty neighbourhood (e.g. no data within range), no weights to solve for
+        return np.zeros_like(c)
+    try:
+        return cho_solve(cho_factor(C, lower=True, check_finite=False), c, check_finite=False)
+    except np.linalg.LinAlgError:
+        return np.linalg.solve(C, c)
+
 # TODO: check with new ordianry kriging and nugget effect
 def simple_kriging(a, b, prop, var_mod, inp_mean):
     '''
@@ -312,27 +348,36 @@ def simple_kriging(a, b, prop, var_mod, inp_mean):
         std_ok (float?): single scalar variance value for estimate at target location
     '''
 
-    # empty matrix building
-    shape = len(a)
-    C = np.zeros((shape, shape))
-    c = np.zeros((shape))
-    w = np.zeros((shape))
-
     # Filling matrices with covariances based on calculated distances
-    C[:shape, :shape] = var_mod.calculate_covariance(b) #? cov or semiv
-    c[:shape] = var_mod.calculate_covariance(a) #? cov or semiv
+    C = var_mod.calculate_covariance(b) #? cov or semiv
+    c = var_mod.calculate_covariance(a) #? cov or semiv
+
+    return _simple_kriging_from_covariance(c, C, prop, var_mod, inp_mean)
+
+def _simple_kriging_from_covariance(c, C, prop, var_mod, inp_mean):
+    '''
+    Simple kriging for covariances that are already evaluated from the distances.
+    Args:
+        c (np.array): covariance vector between target point and moving neighbourhood
+        C (np.array): covariance matrix between locations in moving neighbourhood
+        prop (np.array): array containing scalar property values of locations in moving neighbourhood
+        var_mod: variogram model object
+    Returns:
+        result (float?): single scalar property value estimated for target location
+        std_ok (float?): single scalar variance value for estimate at target location
+    '''
 
     # nugget effect for simple kriging - dont remember why i set this actively, should be the same
     #np.fill_diagonal(C, self.sill)
 
     # TODO: find way to check quality of matrix and solutions for instability
     # Solve Kriging equations
-    w = np.linalg.solve(C, c)
+    w = solve_covariance_system(C, c)
 
     # calculating estimate and variance for kriging
-    pred_var = var_mod.sill - np.sum(w * c)
+    pred_var = var_mod.sill - np.dot(w, c)
     # Note that here the input mean is required, if kriged mean equivalent to OK
-    result = inp_mean + np.sum(w * (prop - inp_mean))
+    result = inp_mean + np.dot(w, prop - inp_mean)
 
     return result, pred_var
 
@@ -349,15 +394,29 @@ def ordinary_kriging(a, b, prop, var_mod):
         std_ok (float?): single scalar variance value for estimate at target location
     '''
 
-    # empty matrix building for OK
-    shape = len(a)
-    C = np.zeros((shape + 1, shape + 1))
-    c = np.zeros((shape + 1))
-    w = np.zeros((shape + 1))
+    return _ordinary_kriging_from_semivariance(var_mod.calculate_semivariance(a),
+                                               var_mod.calculate_semivariance(b), prop)
+
+def _ordinary_kriging_from_semivariance(g, G, prop):
+    '''
+    Ordinary kriging for semivariances that are already evaluated from the distances.
+    Args:
+        g (np.array): semivariance vector between target point and moving neighbourhood
+        G (np.array): semivariance matrix between locations in moving neighbourhood
+        prop (np.array): array containing scalar property values of locations in moving neighbourhood
+    Returns:
+        result (float?): single scalar property value estimated for target location
+        std_ok (float?): single scalar variance value for estimate at target location
+    '''
+
+    # matrix building for OK, every entry is written below so no zero initialization is needed
+    shape = len(g)
+    C = np.empty((shape + 1, shape + 1))
+    c = np.empty((shape + 1))
 
     # filling matirces based on model for spatial correlation
-    C[:shape, :shape] = var_mod.calculate_semivariance(b)
-    c[:shape] = var_mod.calculate_semivariance(a)
+    C[:shape, :shape] = G
+    c[:shape] = g
 
     # matrix setup - compare pykrige, special for OK
     np.fill_diagonal(C, 0)  # this needs to be done as semivariance for distance 0 is 0 by definition
@@ -375,8 +434,74 @@ def ordinary_kriging(a, b, prop, var_mod):
     w = np.linalg.solve(C, c)
 
     # calculating estimate and variance for kriging
-    pred_var = w[shape] + np.sum(w[:shape] * c[:shape])
-    result = np.sum(w[:shape] * prop)
+    pred_var = w[shape] + np.dot(w[:shape], c[:shape])
+    result = np.dot(w[:shape], prop)
+
+    return result, pred_var
+
+def simple_kriging_all(a, b, prop, var_mod, inp_mean):
+    '''
+    Method for simple kriging calculation of several target points sharing the same neighbourhood. Since the
+    covariance matrix is the same for all of them, the kriging equations are solved at once for all targets.
+    Args:
+        a (np.array): distance matrix containing all distances between target points (rows) and neighbourhood
+        b (np.array): distance matrix containing all inter-point distances between locations in neighbourhood
+        prop (np.array): array containing scalar property values of locations in neighbourhood
+        var_mod: variogram model object
+    Returns:
+        result (np.array): scalar property values estimated for each target location
+        pred_var (np.array): variance values for the estimate at each target location
+    '''
+
+    # Filling matrices with covariances based on calculated distances. One column per target point
+    C = var_mod.calculate_covariance(b)
+    c = var_mod.calculate_covariance(a.T)
+
+    # Solve Kriging equations for all right hand sides
+    w = solve_covariance_system(C, c)
+
+    # calculating estimates and variances for kriging
+    pred_var = var_mod.sill - np.einsum('ij,ij->j', w, c)
+    result = inp_mean + np.dot(prop - inp_mean, w)
+
+    return result, pred_var
+
+def ordinary_kriging_all(a, b, prop, var_mod):
+    '''
+    Method for ordinary kriging calculation of several target points sharing the same neighbourhood. Since the
+    kriging matrix is the same for all of them, the kriging equations are solved at once for all targets.
+    Args:
+        a (np.array): distance matrix containing all distances between target points (rows) and neighbourhood
+        b (np.array): distance matrix containing all inter-point distances between locations in neighbourhood
+        prop (np.array): array containing scalar property values of locations in neighbourhood
+        var_mod: variogram model object
+    Returns:
+        result (np.array): scalar property values estimated for each target location
+        pred_var (np.array): variance values for the estimate at each target location
+    '''
+
+    # matrix building for OK, every entry is written below. One column of c per target point
+    shape = len(b)
+    C = np.empty((shape + 1, shape + 1))
+    c = np.empty((shape + 1, len(a)))
+
+    # filling matirces based on model for spatial correlation
+    C[:shape, :shape] = var_mod.calculate_semivariance(b)
+    c[:shape] = var_mod.calculate_semivariance(a.T)
+
+    # matrix setup - compare pykrige, special for OK
+    np.fill_diagonal(C, 0)  # this needs to be done as semivariance for distance 0 is 0 by definition
+    C[shape, :] = 1.0
+    C[:, shape] = 1.0
+    C[shape, shape] = 0.0
+    c[shape] = 1.0
+
+    # Solve Kriging equations for all right hand sides
+    w = np.linalg.solve(C, c)
+
+    # calculating estimates and variances for kriging
+    pred_var = w[shape] + np.einsum('ij,ij->j', w[:shape], c[:shape])
+    result = np.dot(prop, w[:shape])
 
     return result, pred_var
 
@@ -386,73 +511,93 @@ def create_kriged_field(domain, variogram_model, distance_type='euclidian',
     Method to create a kriged field over the defined grid of the gempy solution depending on the defined
     input data (conditioning).
     Returns:
-        self.results_df (pandas dataframe):   Dataframe containing coordinates, kriging estimate
-                                                    and kriging variance for each grid point
+        field_solution: Solution containing coordinates, kriging estimate and kriging variance for each
+                        grid point
     '''
+    # local references to the domain arrays used in the loop below
+    krig_grid = domain.krig_grid
+    coords = domain.coords
+    values = domain.values
+
     # empty arrays for results (estimated values and variances)
-    kriging_result_vals = np.zeros(len(domain.krig_grid))
-    kriging_result_vars = np.zeros(len(domain.krig_grid))
+    kriging_result_vals = np.zeros(len(krig_grid))
+    kriging_result_vars = np.zeros(len(krig_grid))
 
     # Start with distance calculation
     # 1) all grid points to all data points
     # 2) all data points among each other
     if distance_type == 'euclidian':
-        # calculate distances between all input data points
-        dist_all_to_all = cdist(domain.data[:, :3], domain.data[:, :3])
-        # calculate distances between all grid points and all input data points
-        dist_grid_to_all = cdist(domain.krig_grid, domain.data[:, :3])
-
-    # Main loop that goes through whole domain (grid)
-    for i in range(len(domain.krig_grid)):
-
-        # STEP 1: Multiple if elif conditions to define moving neighbourhood:
+        # calculate distances between all input data points, only one triangle of the symmetric matrix is computed
+        dist_all_to_all = squareform(pdist(coords))
         if moving_neighbourhood == 'all':
-            # cutting matrices and properties based on moving neighbourhood
-            a = dist_grid_to_all[i]
-            b = dist_all_to_all
-            prop = domain.data[:, 3]
-
-        elif moving_neighbourhood == 'n_closest':
-            # cutting matrices and properties based on moving neighbourhood
-            a = np.sort(dist_grid_to_all[i])
-            a = a[:n_closest_points]
-            aux = np.argsort(dist_grid_to_all[i])
-            prop = domain.data[:, 3][aux]
-            prop = prop[:n_closest_points]
-            aux = aux[:n_closest_points]
-            b = dist_all_to_all[np.ix_(aux, aux)]
-
-        elif moving_neighbourhood == 'range':
-            # cutting matrices and properties based on moving neighbourhood
-            aux = np.where(dist_grid_to_all[i] <= variogram_model.range_)[0]
-            a = dist_grid_to_all[i][aux]
-            prop = domain.data[:, 3][aux]
-            b = dist_all_to_all[np.ix_(aux, aux)]
-
+            # calculate distances between all grid points and all input data points
+            dist_grid_to_all = cdist(krig_grid, coords)
         else:
-            print("FATAL ERROR: Moving neighbourhood not understood")
-
-        # STEP 2: Multiple if elif conditions to calculate kriging at point
+            # only the neighbours of each grid point are needed, so they are looked up in a kd-tree
+            # instead of computing the distances from every grid point to every data point
+            tree = cKDTree(coords)
+            if moving_neighbourhood == 'n_closest':
+                dist_grid_to_closest, closest = tree.query(krig_grid,
+                                                           k=min(n_closest_points, len(values)))
+                dist_grid_to_closest = dist_grid_to_closest.reshape(len(krig_grid), -1)
+                closest = closest.reshape(len(krig_grid), -1)
+            elif moving_neighbourhood == 'range':
+                in_range = tree.query_ball_point(krig_grid, r=variogram_model.range_)
+
+    # The neighbourhood is the same for every grid point, so the whole domain is solved at once
+    if moving_neighbourhood == 'all':
         if kriging_type == 'OK':
-            val, var = ordinary_kriging(a, b, prop, variogram_model)
+            kriging_result_vals, kriging_result_vars = ordinary_kriging_all(
+                dist_grid_to_all, dist_all_to_all, values, variogram_model)
         elif kriging_type == 'SK':
-            val, var = simple_kriging(a, b, prop, variogram_model, domain.inp_mean)
+            kriging_result_vals, kriging_result_vars = simple_kriging_all(
+                dist_grid_to_all, dist_all_to_all, values, variogram_model, domain.inp_mean)
         elif kriging_type == 'UK':
             print("Universal Kriging not implemented")
         else:
             print("FATAL ERROR: Kriging type not understood")
 
-        # STEP 3: Save results
-        kriging_result_vals[i] = val
-        kriging_result_vars[i] = var
+    else:
+        # Main loop that goes through whole domain (grid)
+        for i in range(len(krig_grid)):
+
+            # STEP 1: Multiple if elif conditions to define moving neighbourhood:
+            if moving_neighbourhood == 'n_closest':
+                # cutting matrices and properties based on moving neighbourhood
+                aux = closest[i]
+                a = dist_grid_to_closest[i]
+                prop = values[aux]
+                b = dist_all_to_all[np.ix_(aux, aux)]
+
+            elif moving_neighbourhood == 'range':
+                # cutting matrices and properties based on moving neighbourhood
+                aux = np.sort(np.asarray(in_range[i], dtype=int))
+                a = cdist(krig_grid[[i]], coords[aux])[0]
+                prop = values[aux]
+                b = dist_all_to_all[np.ix_(aux, aux)]
 
-    # create dataframe of results data for calling
-    d = {'X': domain.krig_grid[:, 0], 'Y': domain.krig_grid[:, 1], 'Z': domain.krig_grid[:, 2],
-        'estimated value': kriging_result_vals, 'estimation variance': kriging_result_vars}
+            else:
+                print("FATAL ERROR: Moving neighbourhood not understood")
+
+            # STEP 2: Multiple if elif conditions to calculate kriging at point
+            if kriging_type == 'OK':
+                val, var = ordinary_kriging(a, b, prop, variogram_model)
+            elif kriging_type == 'SK':
+                val, var = simple_kriging(a, b, prop, variogram_model, domain.inp_mean)
+            elif kriging_type == 'UK':
+                print("Universal Kriging not implemented")
+            else:
+                print("FATAL ERROR: Kriging type not understood")
 
-    results_df = pd.DataFrame(data=d)
+            # STEP 3: Save results
+            kriging_result_vals[i] = val
+            kriging_result_vars[i] = var
 
-    return field_solution(domain, variogram_model, results_df, field_type='interpolation')
+    # create dataframe of results data for calling
+    results = {'X': krig_grid[:, 0], 'Y': krig_grid[:, 1], 'Z': krig_grid[:, 2],
+               'estimated value': kriging_result_vals, 'estimation variance': kriging_result_vars}
+
+    return field_solution(domain, variogram_model, results, field_type='interpolation')
 
 def create_gaussian_field(domain, variogram_model, distance_type='euclidian',
                         moving_neighbourhood='all', kriging_type='OK', n_closest_points=20):
@@ -460,20 +605,21 @@ def create_gaussian_field(domain, variogram_model, distance_type='euclidian',
     Method to create a kriged field over the defined grid of the gempy solution depending on the defined
     input data (conditioning).
     Returns:
-        self.results_df (pandas dataframe):   Dataframe containing coordinates, kriging estimate
-                                                        and kriging variance for each grid point
+        field_solution: Solution containing coordinates, simulated value and kriging variance for each
+                        grid point
     '''
     # perform SGS with same options as kriging
     # TODO: set options for no starting points (Gaussian field) - mean and variance
 
     # set random path through all unknown locations
-    shuffled_grid = domain.krig_grid
-    np.random.shuffle(shuffled_grid)
+    path = np.random.permutation(len(domain.krig_grid))
+    shuffled_grid = domain.krig_grid[path]
 
     # append shuffled grid to input locations
-    sgs_locations = np.vstack((domain.data[:,:3],shuffled_grid))
-    # create array for input properties
-    sgs_prop_updating = domain.data[:,3] # use this and then always stack new ant end
+    sgs_locations = np.vstack((domain.coords, shuffled_grid))
+    # create array for input and simulated properties, filled in order of path
+    sgs_prop_updating = np.empty(len(sgs_locations))
+    sgs_prop_updating[:len(domain.values)] = domain.values
 
     # container for estimation variances
     estimation_var = np.zeros(len(shuffled_grid))
@@ -481,62 +627,78 @@ def create_gaussian_field(domain, variogram_model, distance_type='euclidian',
     # - distance calculation (stays the same)
     # 1) all points to all points in order of path
     # 2) known locations at beginning?
-    if distance_type == 'euclidian':
-        # calculate distances between all input data points
-        dist_all_to_all = cdist(sgs_locations, sgs_locations)
+    # Only the 'all' neighbourhood uses the whole (growing) distance matrix. For local neighbourhoods the
+    # distances are computed on demand for each point, which keeps memory linear in the number of points
+    model_all_to_all = None
+    if distance_type == 'euclidian' and moving_neighbourhood == 'all':
+        # calculate distances between all input data points, only one triangle of the symmetric matrix is computed
+        dist_all_to_all = squareform(pdist(sgs_locations))
+        # every step uses a slice of the same matrix, so the variogram is evaluated only once for all points
+        if kriging_type == 'OK':
+            model_all_to_all = variogram_model.calculate_semivariance(dist_all_to_all)
+        elif kriging_type == 'SK':
+            model_all_to_all = variogram_model.calculate_covariance(dist_all_to_all)
+        del dist_all_to_all
 
     # set counter og active data (start=input data, grwoing by 1 newly calcualted point each run)
-    active_data = len(sgs_prop_updating)
+    active_data = len(domain.values)
 
     # Main loop that goes through whole domain (grid)
     for i in range(len(domain.krig_grid)):
         # STEP 1: cut update distance matrix to correct size
         # HAVE TO CHECK IF THIS IS REALLY CORRECT
-        active_distance_matrix = dist_all_to_all[:active_data,:active_data]
-        active_distance_vector = dist_all_to_all[:,active_data] #basically next point to be simulated
-        active_distance_vector = active_distance_vector[:active_data] #cut to left or diagonal
+        if model_all_to_all is not None:
+            # semivariances (OK) or covariances (SK) instead of distances
+            active_model_matrix = model_all_to_all[:active_data,:active_data]
+            active_model_vector = model_all_to_all[:,active_data] #basically next point to be simulated
+            active_model_vector = active_model_vector[:active_data] #cut to left or diagonal
+        else:
+            # distances between the next point to be simulated and all known locations
+            active_distance_vector = cdist(sgs_locations[[active_data]], sgs_locations[:active_data])[0]
 
         # TODO: NEED PART FOR ZERO INPUT OR NO POINTS IN RANGE OR LESS THAN N POINTS
 
         # STEP 2: Multiple if elif conditions to define moving neighbourhood:
         if moving_neighbourhood == 'all':
             # cutting matrices and properties based on moving neighbourhood
-            a = active_distance_vector
-            b = active_distance_matrix
-            prop = sgs_prop_updating
+            a = active_model_vector
+            b = active_model_matrix
+            prop = sgs_prop_updating[:active_data]
 
         elif moving_neighbourhood == 'n_closest':
             # cutting matrices and properties based on moving neighbourhood
 
             # This seems to work
-            if len(sgs_prop_updating) <= n_closest_points:
+            if active_data <= n_closest_points:
                 a = active_distance_vector[:active_data]
-                b = active_distance_matrix[:active_data,:active_data]
-                prop = sgs_prop_updating
+                b = squareform(pdist(sgs_locations[:active_data]))
+                prop = sgs_prop_updating[:active_data]
 
             # this does not # DAMN THIS STILL HAS ITSELF RIGHT? PROBLEM!
             else:
-                a = np.sort(active_distance_vector)
-                a = a[:n_closest_points]
-                aux = np.argsort(active_distance_vector)
+                aux = np.argpartition(active_distance_vector, n_closest_points - 1)[:n_closest_points]
+                a = active_distance_vector[aux]
                 prop = sgs_prop_updating[aux]
-                prop = prop[:n_closest_points]
-                aux = aux[:n_closest_points]
-                b = active_distance_matrix[np.ix_(aux, aux)]
+                b = cdist(sgs_locations[aux], sgs_locations[aux])
 
         elif moving_neighbourhood == 'range':
             # cutting matrices and properties based on moving neighbourhood
             aux = np.where(active_distance_vector <= variogram_model.range_)[0]
             a = active_distance_vector[aux]
             prop = sgs_prop_updating[aux]
-            b = active_distance_matrix[np.ix_(aux, aux)]
+            # cdist keeps the (0, 0) shape if no known location is in range, squareform would return (1, 1)
+            b = cdist(sgs_locations[aux], sgs_locations[aux])
 
         else:
             print("FATAL ERROR: Moving neighbourhood not understood")
 
         # STEP 3: Multiple if elif conditions to calculate kriging at point
         # TODO: Cover case of data location and grid point coinciding
-        if kriging_type == 'OK':
+        if kriging_type == 'OK' and moving_neighbourhood == 'all':
+            val, var = _ordinary_kriging_from_semivariance(a, b, prop)
+        elif kriging_type == 'SK' and moving_neighbourhood == 'all':
+            val, var = _simple_kriging_from_covariance(a, b, prop, variogram_model, domain.inp_mean)
+        elif kriging_type == 'OK':
             val, var = ordinary_kriging(a, b, prop, variogram_model)
         elif kriging_type == 'SK':
             val, var = simple_kriging(a, b, prop, variogram_model, domain.inp_mean)
@@ -549,24 +711,24 @@ def create_gaussian_field(domain, variogram_model, distance_type='euclidian',
         std_ = np.sqrt(var)
         estimate = np.random.normal(val, scale=std_)
 
-        # append to prop:
-        sgs_prop_updating = np.append(sgs_prop_updating, estimate)
+        # store in prop at the position of the simulated point:
+        sgs_prop_updating[active_data] = estimate
         estimation_var[i]= var
 
         # at end of loop: include simulated point for next step
         active_data += 1
 
-    # delete original input data from results
-    simulated_prop = sgs_prop_updating[len(domain.data[:,3]):] # check if this works like intended
-
-    # create dataframe of results data for calling
-    d = {'X': shuffled_grid[:, 0], 'Y': shuffled_grid[:, 1], 'Z': shuffled_grid[:, 2],
-         'estimated value': simulated_prop, 'estimation variance': estimation_var}
+    # delete original input data from results and put them back from path order into grid order
+    simulated_prop = np.empty(len(shuffled_grid))
+    simulated_prop[path] = sgs_prop_updating[len(domain.values):]
+    simulated_var = np.empty(len(shuffled_grid))
+    simulated_var[path] = estimation_var
 
-    results_df = pd.DataFrame(data=d)
-    results_df = results_df.sort_values(['X','Y','Z'])
+    # create dictionary of results data for calling
+    results = {'X': domain.krig_grid[:, 0], 'Y': domain.krig_grid[:, 1], 'Z': domain.krig_grid[:, 2],
+               'estimated value': simulated_prop, 'estimation variance': simulated_var}
 
-    return field_solution(domain, variogram_model, results_df, field_type='simulation')
+    return field_solution(domain, variogram_model, results, field_type='simulation')
 
 
 
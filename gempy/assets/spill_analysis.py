@@ -21,7 +21,7 @@
 import numpy as np
 from matplotlib import pyplot as plt
 from skimage import measure
-from scipy.spatial import distance
+from scipy.spatial import cKDTree
 
 def get_gradient_minima(geo_data, GX,GY,GZ=np.nan, direction='z', ref='x'):
     """
@@ -98,17 +98,13 @@ def get_gradient_minima(geo_data, GX,GY,GZ=np.nan, direction='z', ref='x'):
         v_gy[:, 1] = (v_gy0[:, 1] * vox_size_y) + geo_data.extent[2]
         v_gy[:, 2] = (v_gy0[:, 2] * vox_size_z) + geo_data.extent[4]
 
-        # calculating this distance takes very long
-        # how cut we possibly simplify this?
-        dist_gxy = distance.cdist(v_gx, v_gy, 'euclidean')
-
         # get distance minima and minima positions for both vertices groups
         # this way we can pair 2 vertices from gx and gy based on their
-        # common distance which is to be minimal (smaller than to all other points)
-        minx = np.min(dist_gxy, axis=1)
-        miny = np.min(dist_gxy, axis=0)
-        minx_pos = np.argmin(dist_gxy, axis=1)
-        miny_pos = np.argmin(dist_gxy, axis=0)
+        # common distance which is to be minimal (smaller than to all other points).
+        # A nearest neighbour query on a kd-tree avoids building the full
+        # (len(v_gx), len(v_gy)) distance matrix
+        minx, minx_pos = cKDTree(v_gy).query(v_gx, k=1)
+        miny, miny_pos = cKDTree(v_gx).query(v_gy, k=1)
 
         # set a cut-off value for minimal distance (here: 3D-diagonal of a voxel/2)
         gx_cut_bool = minx < (vox_size_diag/2)
@@ -162,8 +158,9 @@ def get_gradmin_intersect(geo_data, surface_vertices, grad_minima):
 
     #v_l = np.array(surface_vertices[0])
     v_l = np.array(surface_vertices)
-    l_dist = distance.cdist(grad_minima, v_l)
-    min_dist = np.min(l_dist, axis=0)
+    # only the closest gradient minimum within half a voxel diagonal matters, so
+    # query a kd-tree bounded by that radius instead of the full distance matrix
+    min_dist = cKDTree(grad_minima).query(v_l, k=1, distance_upper_bound=vox_size_diag/2)[0]
     l_cut_bool = min_dist < (vox_size_diag/2)
     intersect = v_l[l_cut_bool]
     return intersect
@@ -302,10 +299,9 @@ def get_surface_extrema(geo_data, surface_vertices, GX, GY, ref='x'):
         MIN_coord[:, 1] = (MIN_coord0[:, 1] * vox_size_y) + geo_data.extent[2] # + vox_size_y/2
         MIN_coord[:, 2] = (MIN_coord0[:, 2] * vox_size_z) + geo_data.extent[4] # + vox_size_z/2
         # get distances between intersection and the according extrema coordinates
-        dist_MIN = distance.cdist(intersect, MIN_coord, 'euclidean')
         # classify intersection extrema by limiting to distance to according voxel coordinates
         # half a voxel-diagonal to get what is "inside" a voxel (best results, yet)
-        min_dist_MIN = np.min(dist_MIN, axis=1)
+        min_dist_MIN = cKDTree(MIN_coord).query(intersect, k=1, distance_upper_bound=vox_size_diag / 2)[0]
         cut_bool_MIN = min_dist_MIN < (vox_size_diag / 2)
         intersect_minima_all = intersect[cut_bool_MIN]
     else:
@@ -318,8 +314,7 @@ def get_surface_extrema(geo_data, surface_vertices, GX, GY, ref='x'):
         MAX_coord[:, 0] = (MAX_coord0[:, 0] * vox_size_x) + geo_data.extent[0] # + vox_size_x/2
         MAX_coord[:, 1] = (MAX_coord0[:, 1] * vox_size_y) + geo_data.extent[2] # + vox_size_y/2
         MAX_coord[:, 2] = (MAX_coord0[:, 2] * vox_size_z) + geo_data.extent[4] # + vox_size_z/2
-        dist_MAX = distance.cdist(intersect, MAX_coord, 'euclidean')
-        min_dist_MAX = np.min(dist_MAX, axis=1)
+        min_dist_MAX = cKDTree(MAX_coord).query(intersect, k=1, distance_upper_bound=vox_size_diag / 2)[0]
         cut_bool_MAX = min_dist_MAX < (vox_size_diag / 2)
         intersect_maxima_all = intersect[cut_bool_MAX]
     else:
@@ -332,8 +327,7 @@ def get_surface_extrema(geo_data, surface_vertices, GX, GY, ref='x'):
         SADD_coord[:, 0] = (SADD_coord0[:, 0] * vox_size_x) + geo_data.extent[0] # + vox_size_x/2
         SADD_coord[:, 1] = (SADD_coord0[:, 1] * vox_size_y) + geo_data.extent[2] # + vox_size_y/2
         SADD_coord[:, 2] = (SADD_coord0[:, 2] * vox_size_z) + geo_data.extent[4] # + vox_size_z/2
-        dist_SADD = distance.cdist(intersect, SADD_coord, 'euclidean')
-        min_dist_SADD = np.min(dist_SADD, axis=1)
+        min_dist_SADD = cKDTree(SADD_coord).query(intersect, k=1, distance_upper_bound=vox_size_diag / 2)[0]
         cut_bool_SADD = min_dist_SADD < (vox_size_diag / 2)
         intersect_saddles_all = intersect[cut_bool_SADD]
     else:
@@ -1,3 +1,4 @@
+import itertools
 from gempy.core.grid_modules.create_topography import LoadDEMArtificial, LoadDEMGDAL
 import numpy as np
 import skimage.transform
@@ -8,6 +9,10 @@ from gempy.utils.meta import _setdoc_pro
 import gempy.utils.docstring as ds
 import pandas as pn
 
+# This is the vector that determines the sign of each corner of the voxel, in the
+# itertools.product(x_cor, y_cor, z_cor) order used by the tz kernel
+_TZ_CORNER_SIGNS = (1, -1, -1, 1, -1, 1, 1, -1)
+
 
 class RegularGrid:
     """
@@ -72,7 +77,7 @@ class RegularGrid:
 
         coords = self.set_coord(extent, resolution)
         g = np.meshgrid(*coords, indexing="ij")
-        values = np.vstack(tuple(map(np.ravel, g))).T.astype("float64")
+        values = np.stack(g, axis=-1).reshape(-1, 3).astype("float64", copy=False)
         return values
 
     def get_dx_dy_dz(self, rescale=False):
@@ -392,9 +397,9 @@ class CenteredGrid:
         g = np.meshgrid(*g_2)
         d_left = np.meshgrid(d_[0][:-1] / 2, d_[1][:-1] / 2, d_[2][:-1] / 2)
         d_right = np.meshgrid(d_[0][1:] / 2, d_[1][1:] / 2, d_[2][1:] / 2)
-        kernel_g = np.vstack(tuple(map(np.ravel, g))).T.astype("float64")
-        kernel_d_left = np.vstack(tuple(map(np.ravel, d_left))).T.astype("float64")
-        kernel_d_right = np.vstack(tuple(map(np.ravel, d_right))).T.astype("float64")
+        kernel_g = np.stack(g, axis=-1).reshape(-1, 3).astype("float64", copy=False)
+        kernel_d_left = np.stack(d_left, axis=-1).reshape(-1, 3).astype("float64", copy=False)
+        kernel_d_right = np.stack(d_right, axis=-1).reshape(-1, 3).astype("float64", copy=False)
 
         return kernel_g, kernel_d_left, kernel_d_right
 
@@ -430,7 +435,6 @@ class CenteredGrid:
 
         """
 
-        self.values = np.empty((0, 3))
         centers = np.atleast_2d(centers)
 
         if kernel_centers is None:
@@ -439,8 +443,8 @@ class CenteredGrid:
         assert centers.shape[
                    1] == 3, 'Centers must be a numpy array that contains the coordinates XYZ'
 
-        for i in centers:
-            self.values = np.vstack((self.values, i + kernel_centers))
+        # One kernel per center, stacked in center order
+        self.values = (centers[:, None, :] + kernel_centers[None, :, :]).reshape(-1, 3)
 
         self.length = self.values.shape[0]
 
@@ -455,32 +459,22 @@ class CenteredGrid:
         s_gr_z = grid_values[:, 2]
 
         # getting the coordinates of the corners of the voxel...
-        x_cor = np.stack((s_gr_x - self.kernel_dxyz_left[:, 0],
-                          s_gr_x + self.kernel_dxyz_right[:, 0]), axis=1)
-        y_cor = np.stack((s_gr_y - self.kernel_dxyz_left[:, 1],
-                          s_gr_y + self.kernel_dxyz_right[:, 1]), axis=1)
-        z_cor = np.stack((s_gr_z - self.kernel_dxyz_left[:, 2],
-                          s_gr_z + self.kernel_dxyz_right[:, 2]), axis=1)
-
-        # ...and prepare them for a vectorial op
-        x_matrix = np.repeat(x_cor, 4, axis=1)
-        y_matrix = np.tile(np.repeat(y_cor, 2, axis=1), (1, 2))
-        z_matrix = np.tile(z_cor, (1, 4))
-
-        s_r = np.sqrt(x_matrix ** 2 + y_matrix ** 2 + z_matrix ** 2)
-
-        # This is the vector that determines the sign of the corner of the voxel
-        mu = np.array([1, -1, -1, 1, -1, 1, 1, -1])
-
-        self.tz = (
-            np.sum(- 1 *
-                   G *
-                   mu * (
-                           x_matrix * np.log(y_matrix + s_r) +
-                           y_matrix * np.log(x_matrix + s_r) -
-                           z_matrix * np.arctan(
-                       x_matrix * y_matrix / (z_matrix * s_r))),
-                   axis=1))
+        x_cor = (s_gr_x - self.kernel_dxyz_left[:, 0],
+                 s_gr_x + self.kernel_dxyz_right[:, 0])
+        y_cor = (s_gr_y - self.kernel_dxyz_left[:, 1],
+                 s_gr_y + self.kernel_dxyz_right[:, 1])
+        z_cor = (s_gr_z - self.kernel_dxyz_left[:, 2],
+                 s_gr_z + self.kernel_dxyz_right[:, 2])
+
+        # ...and add up the 8 corners one at a time instead of materializing (n, 8) matrices
+        tz = np.zeros(grid_values.shape[0])
+        for mu, (x, y, z) in zip(_TZ_CORNER_SIGNS, itertools.product(x_cor, y_cor, z_cor)):
+            s_r = np.sqrt(x ** 2 + y ** 2 + z ** 2)
+            tz -= mu * (x * np.log(y + s_r) +
+                        y * np.log(x + s_r) -
+                        z * np.arctan(x * y / (z * s_r)))
+
+        self.tz = G * tz
 
         return self.tz
 
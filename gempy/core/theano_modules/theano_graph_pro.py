@@ -30,7 +30,6 @@ from theano import sparse
 
 import theano.ifelse as tif
 import numpy as np
-import sys
 
 # check if skcuda is installed
 try:
@@ -135,10 +134,17 @@ class TheanoGraphPro(object):
                 - gradient[bool]: If true adapt the graph for AD
                 - max_speed[int]: As the number gets higher true graph will be adapted to return meaningful
                  gradients with AD
+                - cholesky[bool]: If true the kriging system is solved on cpu by the Cholesky factor of the
+                 covariances, falling back to a general solve if they are not numerically positive definite. If
+                 false only the general solve is used. Default is true for float64 only, since in float32 the
+                 covariances of large models are often not positive definite
         """
         self.lenght_of_faults = T.cast(0, 'int32')
         self.pi = theano.shared(3.14159265359, 'pi')
 
+        # Inputs and outputs of the last call of matrices_shapes
+        self._matrices_shapes_cache = (None, None)
+
         # OPTIONS
         # -------
         if output is None:
@@ -160,6 +166,7 @@ class TheanoGraphPro(object):
         # Trade speed for memory this will consume more memory
         self.max_speed = kwargs.get('max_speed', 1)
         self.sparse_version = kwargs.get('sparse_version', False)
+        self.cholesky = kwargs.get('cholesky', dtype == 'float64')
 
         self.gradient = kwargs.get('gradient', False)
         self.device = theano.config.device
@@ -222,9 +229,7 @@ class TheanoGraphPro(object):
         self.len_points = self.surface_points_all.shape[0] - \
                           self.number_of_points_per_surface_T.shape[0]
 
-        # Tiling dips to the 3 spatial coordinations
         self.dips_position = self.dips_position_all
-        self.dips_position_tiled = T.tile(self.dips_position, (self.n_dimensions, 1))
 
         # These are subsets of the data for each series. I initialized them as the whole arrays but then they will take
         # the data of every potential field
@@ -300,9 +305,6 @@ class TheanoGraphPro(object):
         # It is a matrix because of the values: porosity, sus, etc
         self.values_properties_op = T.matrix('Values that the blocks are taking')
 
-        self.n_surface = T.arange(1, 5000, dtype='int32')
-        self.n_surface.name = 'ID of surfaces'
-
         self.input_parameters_block = [self.dips_position_all, self.dip_angles_all,
                                        self.azimuth_all,
                                        self.polarity_all, self.surface_points_all,
@@ -335,6 +337,10 @@ class TheanoGraphPro(object):
         self.len_series_w = theano.shared(np.arange(2, dtype='int32'),
                                           'Length of weights in every series')
 
+        # The last value of the cumulative number of surfaces is the total number of surfaces
+        self.n_surface = T.arange(1, self.n_surfaces_per_series[-1] + 1, dtype='int32')
+        self.n_surface.name = 'ID of surfaces'
+
         # Control flow
         self.compute_weights_ctrl = T.vector(
             'Vector controlling if weights must be recomputed', dtype='bool')
@@ -448,7 +454,7 @@ class TheanoGraphPro(object):
 
         # We add the axis 1 to the mask. Axis 1 is the properties values axis
         # Then we sum over the 0 axis. Axis 0 is the series
-        final_model = T.sum(T.stack([mask], axis=1) * block, axis=0)
+        final_model = T.sum(mask.dimshuffle(0, 'x', 1) * block, axis=0)
         return final_model
 
     def compute_series(self, grid=None, shift=None):
@@ -486,7 +492,7 @@ class TheanoGraphPro(object):
                        dict(input=self.is_finite_ctrl, taps=[0]),
                        dict(input=self.is_erosion, taps=[0]),
                        dict(input=self.is_onlap, taps=[0]),
-                       dict(input=T.arange(0, 5000, dtype='int32'), taps=[0]),
+                       dict(input=T.arange(0, self.len_series_i.shape[0], dtype='int32'), taps=[0]),
                        dict(input=self.a_T, taps=[0]),
                        dict(input=self.c_o_T_scalar, taps=[0])
                        ],
@@ -809,10 +815,10 @@ class TheanoGraphPro(object):
         ref_points = ref_points_loop[-1]
         #  ref_points = T.repeat(self.surface_points_all[ref_positions], number_of_points_per_surface, axis=0)
 
-        rest_mask = T.ones(T.stack([self.surface_points_all.shape[0]]),
-                           dtype='int16')
-        rest_mask = T.set_subtensor(rest_mask[ref_positions], 0)
-        rest_mask = T.nonzero(rest_mask)[0]
+        # Positions of the rest points. Every rest point is shifted by the number of reference points before it,
+        # i.e. by the id of its surface plus one
+        rest_mask = T.arange(cum_rep[-1]) + T.extra_ops.repeat(
+            T.arange(1, number_of_points_per_surface.shape[0] + 1), number_of_points_per_surface)
         rest_points = self.surface_points_all[rest_mask]
         return [ref_points, rest_points, ref_positions, rest_mask]
 
@@ -851,10 +857,14 @@ class TheanoGraphPro(object):
             theano.tensor.matrix: Distancse matrix. shape n_points x n_points
         """
 
+        # Squared norms of the points. For the distances of a set of points to itself they are only built once
+        sqr_norm_1 = T.sqr(x_1).sum(1)
+        sqr_norm_2 = sqr_norm_1 if x_2 is x_1 else T.sqr(x_2).sum(1)
+
         # T.maximum avoid negative numbers increasing stability
         sqd = T.sqrt(T.maximum(
-            (x_1 ** 2).sum(1).reshape((x_1.shape[0], 1)) +
-            (x_2 ** 2).sum(1).reshape((1, x_2.shape[0])) -
+            sqr_norm_1.reshape((x_1.shape[0], 1)) +
+            sqr_norm_2.reshape((1, x_2.shape[0])) -
             2 * x_1.dot(x_2.T), 1e-12
         ))
         return sqd
@@ -867,8 +877,17 @@ class TheanoGraphPro(object):
              length_of_CG, length_of_CGI, length_of_U_I, length_of_faults, length_of_C
         """
 
+        # The shapes only change when a new series sets its data, so within one series the same nodes are reused
+        # instead of adding new ones to the graph at every call
+        shapes_input = (self.dips_position, self.rest_layer_points, self.n_universal_eq_T_op,
+                        self.lenght_of_faults)
+        cached_input, cached_shapes = self._matrices_shapes_cache
+        if cached_input is not None and all(i is j for i, j in zip(shapes_input, cached_input)):
+            return cached_shapes
+
         # Calculating the dimensions of the
-        length_of_CG = self.dips_position_tiled.shape[0]
+        # Every dip gives one gradient per spatial direction
+        length_of_CG = self.n_dimensions * self.dips_position.shape[0]
         length_of_CGI = self.rest_layer_points.shape[0]
         length_of_U_I = self.n_universal_eq_T_op
 
@@ -885,7 +904,58 @@ class TheanoGraphPro(object):
                 length_of_faults)
             length_of_C = theano.printing.Print("length_of_C")(length_of_C)
 
-        return length_of_CG, length_of_CGI, length_of_U_I, length_of_faults, length_of_C
+        shapes = (length_of_CG, length_of_CGI, length_of_U_I, length_of_faults, length_of_C)
+        self._matrices_shapes_cache = (shapes_input, shapes)
+        return shapes
+
+    def cov_function(self, sed):
+        """
+        Cubic covariance function, without the covariance at 0, evaluated at the given distances. The powers of the
+        range are scalars, so they are inverted once instead of dividing every distance, and the polynomial is
+        nested in Horner form to keep the number of intermediate matrices low
+
+        Args:
+            sed (theano.tensor.matrix): euclidean distances
+
+        Returns:
+            theano.tensor.matrix: covariance. Same shape as sed
+        """
+        r = sed * (1. / self.a_T_scalar)
+        r_2 = r ** 2
+        return (sed < self.a_T_scalar) * (1 + r_2 * (-7 + r * (35 / 4 + r_2 * (-7 / 2 + 3 / 4 * r_2))))
+
+    def cov_first_derivative(self, sed):
+        """
+        First derivative of the cubic covariance function divided by the distance, evaluated at the given
+        distances in Horner form
+
+        Args:
+            sed (theano.tensor.matrix): euclidean distances
+
+        Returns:
+            theano.tensor.matrix: first derivative of the covariance. Same shape as sed
+        """
+        inv_a = 1. / self.a_T_scalar
+        r = sed * inv_a
+        r_2 = r ** 2
+        return (sed < self.a_T_scalar) * (self.c_o_T_scalar * inv_a ** 2) * (
+                -14 + r * (105 / 4 + r_2 * (-35 / 2 + 21 / 4 * r_2)))
+
+    def cov_second_derivative(self, sed):
+        """
+        Second derivative of the cubic covariance function, evaluated at the given distances in Horner form
+
+        Args:
+            sed (theano.tensor.matrix): euclidean distances
+
+        Returns:
+            theano.tensor.matrix: second derivative of the covariance. Same shape as sed
+        """
+        inv_a = 1. / self.a_T_scalar
+        r = sed * inv_a
+        r_2 = r ** 2
+        return (sed < self.a_T_scalar) * (self.c_o_T_scalar * inv_a ** 2) * (
+                -14 + r * (105 / 2 + r_2 * (-70 + 63 / 2 * r_2)))
 
     # endregion
 
@@ -900,38 +970,21 @@ class TheanoGraphPro(object):
 
         """
 
-        # Compute euclidian distances
-        sed_rest_rest = self.squared_euclidean_distances(self.rest_layer_points,
-                                                         self.rest_layer_points)
-        sed_ref_rest = self.squared_euclidean_distances(self.ref_layer_points,
-                                                        self.rest_layer_points)
-        sed_rest_ref = self.squared_euclidean_distances(self.rest_layer_points,
-                                                        self.ref_layer_points)
-        sed_ref_ref = self.squared_euclidean_distances(self.ref_layer_points,
-                                                       self.ref_layer_points)
+        # Compute euclidian distances. Rest and reference points are stacked so the distances and the
+        # covariance polynomial are evaluated only once for the four blocks
+        n_rest = self.rest_layer_points.shape[0]
+        rest_ref = T.concatenate([self.rest_layer_points, self.ref_layer_points], axis=0)
+        sed = self.squared_euclidean_distances(rest_ref, rest_ref)
+
+        # Covariance between all the stacked points
+        cov = self.cov_function(sed)
 
         # Covariance matrix for surface_points
         C_I = (self.c_o_T_scalar * self.i_reescale * (
-                (sed_rest_rest < self.a_T_scalar) *  # Rest - Rest Covariances Matrix
-                (1 - 7 * (sed_rest_rest / self.a_T_scalar) ** 2 +
-                 35 / 4 * (sed_rest_rest / self.a_T_scalar) ** 3 -
-                 7 / 2 * (sed_rest_rest / self.a_T_scalar) ** 5 +
-                 3 / 4 * (sed_rest_rest / self.a_T_scalar) ** 7) -
-                ((sed_ref_rest < self.a_T_scalar) *  # Reference - Rest
-                 (1 - 7 * (sed_ref_rest / self.a_T_scalar) ** 2 +
-                  35 / 4 * (sed_ref_rest / self.a_T_scalar) ** 3 -
-                  7 / 2 * (sed_ref_rest / self.a_T_scalar) ** 5 +
-                  3 / 4 * (sed_ref_rest / self.a_T_scalar) ** 7)) -
-                ((sed_rest_ref < self.a_T_scalar) *  # Rest - Reference
-                 (1 - 7 * (sed_rest_ref / self.a_T_scalar) ** 2 +
-                  35 / 4 * (sed_rest_ref / self.a_T_scalar) ** 3 -
-                  7 / 2 * (sed_rest_ref / self.a_T_scalar) ** 5 +
-                  3 / 4 * (sed_rest_ref / self.a_T_scalar) ** 7)) +
-                ((sed_ref_ref < self.a_T_scalar) *  # Reference - References
-                 (1 - 7 * (sed_ref_ref / self.a_T_scalar) ** 2 +
-                  35 / 4 * (sed_ref_ref / self.a_T_scalar) ** 3 -
-                  7 / 2 * (sed_ref_ref / self.a_T_scalar) ** 5 +
-                  3 / 4 * (sed_ref_ref / self.a_T_scalar) ** 7))))
+                cov[:n_rest, :n_rest] -  # Rest - Rest Covariances Matrix
+                cov[n_rest:, :n_rest] -  # Reference - Rest
+                cov[:n_rest, n_rest:] +  # Rest - Reference
+                cov[n_rest:, n_rest:]))  # Reference - References
 
         # self.nugget_effect_scalar_T_op = theano.printing.Print('nug scalar')(self.nugget_effect_scalar_T_op)
 
@@ -939,7 +992,7 @@ class TheanoGraphPro(object):
         # Add name to the theano node
         C_I.name = 'Covariance SurfacePoints'
 
-        if str(sys._getframe().f_code.co_name) in self.verbose:
+        if 'cov_surface_points' in self.verbose:
             C_I = theano.printing.Print('Cov surface_points')(C_I)
 
         return C_I
@@ -954,48 +1007,34 @@ class TheanoGraphPro(object):
 
          """
 
-        # Euclidean distances
-        sed_dips_dips = self.squared_euclidean_distances(self.dips_position_tiled,
-                                                         self.dips_position_tiled)
+        # Euclidean distances. They are the same for every pair of directions, so the distances and the covariance
+        # derivatives are computed between the dips only and tiled to all directions afterwards
+        sed_dips = self.squared_euclidean_distances(self.dips_position, self.dips_position)
+        sed_dips_dips = T.tile(sed_dips, (self.n_dimensions, self.n_dimensions))
 
         if 'sed_dips_dips' in self.verbose:
             sed_dips_dips = theano.printing.Print('sed_dips_dips')(sed_dips_dips)
 
-        # Cartesian distances between dips positions
-        h_u = T.vertical_stack(
-            T.tile(self.dips_position[:, 0] - self.dips_position[:, 0].reshape(
-                (self.dips_position[:, 0].shape[0], 1)),
-                   self.n_dimensions),
-            T.tile(self.dips_position[:, 1] - self.dips_position[:, 1].reshape(
-                (self.dips_position[:, 1].shape[0], 1)),
-                   self.n_dimensions),
-            T.tile(self.dips_position[:, 2] - self.dips_position[:, 2].reshape(
-                (self.dips_position[:, 2].shape[0], 1)),
-                   self.n_dimensions))
+        # Cartesian distances between dips positions. Differences of all directions at once with shape
+        # (direction, dip, dip), stacked by direction and repeated for every direction along the columns
+        n_dips = self.dips_position.shape[0]
+        h_u = T.tile(
+            (self.dips_position.T.dimshuffle(0, 'x', 1) -
+             self.dips_position.T.dimshuffle(0, 1, 'x')).reshape((self.n_dimensions * n_dips, n_dips)),
+            (1, self.n_dimensions))
 
         # Transpose
         h_v = h_u.T
 
         # Perpendicularity matrix. Boolean matrix to separate cross-covariance and
-        # every gradient direction covariance (block diagonal)
-        perpendicularity_matrix = T.zeros_like(sed_dips_dips)
-
-        # Cross-covariances of x
-        perpendicularity_matrix = T.set_subtensor(
-            perpendicularity_matrix[0:self.dips_position.shape[0],
-            0:self.dips_position.shape[0]], 1)
-
-        # Cross-covariances of y
-        perpendicularity_matrix = T.set_subtensor(
-            perpendicularity_matrix[
-            self.dips_position.shape[0]:self.dips_position.shape[0] * 2,
-            self.dips_position.shape[0]:self.dips_position.shape[0] * 2], 1)
-
-        # Cross-covariances of z
-        perpendicularity_matrix = T.set_subtensor(
-            perpendicularity_matrix[
-            self.dips_position.shape[0] * 2:self.dips_position.shape[0] * 3,
-            self.dips_position.shape[0] * 2:self.dips_position.shape[0] * 3], 1)
+        # every gradient direction covariance (block diagonal). It is 1 where row and column belong to the
+        # same direction x, y or z
+        direction = T.arange(self.n_dimensions * n_dips) // n_dips
+        perpendicularity_matrix = T.eq(direction.reshape((-1, 1)), direction.reshape((1, -1)))
+
+        # First and second derivatives of the covariance. Both are needed twice below so they are built once
+        first_derivative = T.tile(self.cov_first_derivative(sed_dips), (self.n_dimensions, self.n_dimensions))
+        second_derivative = T.tile(self.cov_second_derivative(sed_dips), (self.n_dimensions, self.n_dimensions))
 
         # Covariance matrix for gradients at every xyz direction and their cross-covariances
         C_G = T.switch(
@@ -1003,23 +1042,8 @@ class TheanoGraphPro(object):
             0,  # If true it is equal to 0. This is how a direction affect another
             (  # else, following Chiles book
                     (h_u * h_v / sed_dips_dips ** 2) *
-                    ((
-                             (sed_dips_dips < self.a_T_scalar) *  # first derivative
-                             (-self.c_o_T_scalar * ((
-                                                            -14 / self.a_T_scalar ** 2) + 105 / 4 * sed_dips_dips / self.a_T_scalar ** 3 -
-                                                    35 / 2 * sed_dips_dips ** 3 / self.a_T_scalar ** 5 +
-                                                    21 / 4 * sed_dips_dips ** 5 / self.a_T_scalar ** 7))) +
-                     (sed_dips_dips < self.a_T_scalar) *  # Second derivative
-                     self.c_o_T_scalar * 7 * (
-                             9 * sed_dips_dips ** 5 - 20 * self.a_T_scalar ** 2 * sed_dips_dips ** 3 +
-                             15 * self.a_T_scalar ** 4 * sed_dips_dips - 4 * self.a_T_scalar ** 5) / (
-                             2 * self.a_T_scalar ** 7)) -
-                    (perpendicularity_matrix *
-                     (sed_dips_dips < self.a_T_scalar) *  # first derivative
-                     self.c_o_T_scalar * ((
-                                                  -14 / self.a_T_scalar ** 2) + 105 / 4 * sed_dips_dips / self.a_T_scalar ** 3 -
-                                          35 / 2 * sed_dips_dips ** 3 / self.a_T_scalar ** 5 +
-                                          21 / 4 * sed_dips_dips ** 5 / self.a_T_scalar ** 7)))
+                    (-first_derivative + second_derivative) -
+                    perpendicularity_matrix * first_derivative)
         )
 
         # Setting nugget effect of the gradients
@@ -1031,10 +1055,10 @@ class TheanoGraphPro(object):
 
         if verbose > 1:
             theano.printing.pydotprint(C_G,
-                                       outfile="graphs/" + sys._getframe().f_code.co_name + ".png",
+                                       outfile="graphs/cov_gradients.png",
                                        var_with_name_simple=True)
 
-        if str(sys._getframe().f_code.co_name) in self.verbose:
+        if 'cov_gradients' in self.verbose:
             C_G = theano.printing.Print('Cov Gradients')(C_G)
 
         return C_G
@@ -1047,55 +1071,31 @@ class TheanoGraphPro(object):
               points in dip_pos
         """
 
-        # Euclidian distances
-        sed_dips_rest = self.squared_euclidean_distances(self.dips_position_tiled,
-                                                         self.rest_layer_points)
-        sed_dips_ref = self.squared_euclidean_distances(self.dips_position_tiled,
-                                                        self.ref_layer_points)
-
-        # Cartesian distances between dips and interface points
-        # Rest
-        hu_rest = T.vertical_stack(
-            (self.dips_position[:, 0] - self.rest_layer_points[:, 0].reshape(
-                (self.rest_layer_points[:, 0].shape[0], 1))).T,
-            (self.dips_position[:, 1] - self.rest_layer_points[:, 1].reshape(
-                (self.rest_layer_points[:, 1].shape[0], 1))).T,
-            (self.dips_position[:, 2] - self.rest_layer_points[:, 2].reshape(
-                (self.rest_layer_points[:, 2].shape[0], 1))).T
-        )
+        # Rest and reference points are stacked so the distances and the covariance derivative are evaluated
+        # only once for both
+        n_rest = self.rest_layer_points.shape[0]
+        rest_ref = T.concatenate([self.rest_layer_points, self.ref_layer_points], axis=0)
 
-        # Reference point
-        hu_ref = T.vertical_stack(
-            (self.dips_position[:, 0] - self.ref_layer_points[:, 0].reshape(
-                (self.ref_layer_points[:, 0].shape[0], 1))).T,
-            (self.dips_position[:, 1] - self.ref_layer_points[:, 1].reshape(
-                (self.ref_layer_points[:, 1].shape[0], 1))).T,
-            (self.dips_position[:, 2] - self.ref_layer_points[:, 2].reshape(
-                (self.ref_layer_points[:, 2].shape[0], 1))).T
-        )
+        # Euclidian distances. They do not depend on the direction, so they are computed for the dips only
+        sed_dips_rest_ref = self.squared_euclidean_distances(self.dips_position, rest_ref)
 
-        # Cross-Covariance gradients-surface_points
-        C_GI = self.gi_reescale * (
-                (hu_rest *
-                 (sed_dips_rest < self.a_T_scalar) *  # first derivative
-                 (- self.c_o_T_scalar * ((
-                                                 -14 / self.a_T_scalar ** 2) + 105 / 4 * sed_dips_rest / self.a_T_scalar ** 3 -
-                                         35 / 2 * sed_dips_rest ** 3 / self.a_T_scalar ** 5 +
-                                         21 / 4 * sed_dips_rest ** 5 / self.a_T_scalar ** 7))) -
-                (hu_ref *
-                 (sed_dips_ref < self.a_T_scalar) *  # first derivative
-                 (- self.c_o_T_scalar * ((
-                                                 -14 / self.a_T_scalar ** 2) + 105 / 4 * sed_dips_ref / self.a_T_scalar ** 3 -
-                                         35 / 2 * sed_dips_ref ** 3 / self.a_T_scalar ** 5 +
-                                         21 / 4 * sed_dips_ref ** 5 / self.a_T_scalar ** 7)))
-        ).T
+        # Cartesian distances between dips and interface points, stacked by direction
+        hu_rest_ref = (self.dips_position.T.dimshuffle(0, 1, 'x') -
+                       rest_ref.T.dimshuffle(0, 'x', 1)).reshape(
+            (self.n_dimensions * self.dips_position.shape[0], rest_ref.shape[0]))
+
+        # First derivative of the covariance, tiled to every direction, times the cartesian distance
+        cov_gi = hu_rest_ref * T.tile(-self.cov_first_derivative(sed_dips_rest_ref), (self.n_dimensions, 1))
+
+        # Cross-Covariance gradients-surface_points. Rest minus reference
+        C_GI = self.gi_reescale * (cov_gi[:, :n_rest] - cov_gi[:, n_rest:]).T
 
         # Add name to the theano node
         C_GI.name = 'Covariance gradient interface'
 
-        if str(sys._getframe().f_code.co_name) + '_g' in self.verbose:
+        if 'cov_interface_gradients_g' in self.verbose:
             theano.printing.pydotprint(C_GI,
-                                       outfile="graphs/" + sys._getframe().f_code.co_name + ".png",
+                                       outfile="graphs/cov_interface_gradients.png",
                                        var_with_name_simple=True)
         return C_GI
 
@@ -1114,42 +1114,24 @@ class TheanoGraphPro(object):
         # Condition of universality 2 degree
         # Gradients
 
-        n = self.dips_position.shape[0]
-        U_G = T.zeros((n * self.n_dimensions, 3 * self.n_dimensions))
-        # x
-        U_G = T.set_subtensor(U_G[:n, 0], 1)
-        # y
-        U_G = T.set_subtensor(U_G[n * 1:n * 2, 1], 1)
-        # z
-        U_G = T.set_subtensor(U_G[n * 2: n * 3, 2], 1)
-        # x**2
-        U_G = T.set_subtensor(U_G[:n, 3],
-                              2 * self.gi_reescale * self.dips_position[:, 0])
-        # y**2
-        U_G = T.set_subtensor(U_G[n * 1:n * 2, 4],
-                              2 * self.gi_reescale * self.dips_position[:, 1])
-        # z**2
-        U_G = T.set_subtensor(U_G[n * 2: n * 3, 5],
-                              2 * self.gi_reescale * self.dips_position[:, 2])
-        # xy
-        U_G = T.set_subtensor(U_G[:n, 6], self.gi_reescale * self.dips_position[:,
-                                                             1])  # This is y
-        U_G = T.set_subtensor(U_G[n * 1:n * 2, 6],
-                              self.gi_reescale * self.dips_position[:,
-                                                 0])  # This is x
-        # xz
-        U_G = T.set_subtensor(U_G[:n, 7], self.gi_reescale * self.dips_position[:,
-                                                             2])  # This is z
-        U_G = T.set_subtensor(U_G[n * 2: n * 3, 7],
-                              self.gi_reescale * self.dips_position[:,
-                                                 0])  # This is x
-        # yz
-        U_G = T.set_subtensor(U_G[n * 1:n * 2, 8],
-                              self.gi_reescale * self.dips_position[:,
-                                                 2])  # This is z
-        U_G = T.set_subtensor(U_G[n * 2:n * 3, 8],
-                              self.gi_reescale * self.dips_position[:,
-                                                 1])  # This is y
+        # Every column is the derivative of one drift term, stacked by direction x, y and z of the gradients
+        zeros = T.zeros_like(self.dips_position[:, 0])
+        ones = T.ones_like(self.dips_position[:, 0])
+        x = self.gi_reescale * self.dips_position[:, 0]
+        y = self.gi_reescale * self.dips_position[:, 1]
+        z = self.gi_reescale * self.dips_position[:, 2]
+
+        U_G = T.stack((
+            T.concatenate((ones, zeros, zeros)),  # x
+            T.concatenate((zeros, ones, zeros)),  # y
+            T.concatenate((zeros, zeros, ones)),  # z
+            T.concatenate((2 * x, zeros, zeros)),  # x**2
+            T.concatenate((zeros, 2 * y, zeros)),  # y**2
+            T.concatenate((zeros, zeros, 2 * z)),  # z**2
+            T.concatenate((y, x, zeros)),  # xy
+            T.concatenate((z, zeros, x)),  # xz
+            T.concatenate((zeros, z, y)),  # yz
+        ), axis=1)
 
         # Interface
         U_I = - T.stack(
@@ -1191,19 +1173,18 @@ class TheanoGraphPro(object):
         if 'U_G' in self.verbose:
             U_G = theano.printing.Print('U_G')(U_G)
 
-        if str(sys._getframe().f_code.co_name) + '_g' in self.verbose:
+        if 'universal_matrix_g' in self.verbose:
             theano.printing.pydotprint(U_I,
-                                       outfile="graphs/" + sys._getframe().f_code.co_name + "_i.png",
+                                       outfile="graphs/universal_matrix_i.png",
                                        var_with_name_simple=True)
 
             theano.printing.pydotprint(U_G,
-                                       outfile="graphs/" + sys._getframe().f_code.co_name + "_g.png",
+                                       outfile="graphs/universal_matrix_g.png",
                                        var_with_name_simple=True)
 
         # Add name to the theano node
-        if U_I:
-            U_I.name = 'Drift surface_points'
-            U_G.name = 'Drift foliations'
+        U_I.name = 'Drift surface_points'
+        U_G.name = 'Drift foliations'
 
         return U_I[:, :self.n_universal_eq_T_op], U_G[:, :self.n_universal_eq_T_op]
 
@@ -1242,7 +1223,7 @@ class TheanoGraphPro(object):
         # As long as the drift is a constant F_G is null
         F_G = T.zeros((length_of_faults, length_of_CG)) + 0.0001
 
-        if str(sys._getframe().f_code.co_name) in self.verbose:
+        if 'faults_matrix' in self.verbose:
             F_I = theano.printing.Print('Faults surface_points matrix')(F_I)
             F_G = theano.printing.Print('Faults gradients matrix')(F_G)
 
@@ -1269,64 +1250,20 @@ class TheanoGraphPro(object):
         # =================================
         # Creation of the Covariance Matrix
         # =================================
-        C_matrix = T.zeros((length_of_C, length_of_C))
-
-        # First row of matrices
-        # Set C_G
-        C_matrix = T.set_subtensor(C_matrix[0:length_of_CG, 0:length_of_CG], C_G)
-        # Set CGI
-        C_matrix = T.set_subtensor(
-            C_matrix[0:length_of_CG, length_of_CG:length_of_CG + length_of_CGI],
-            C_GI.T)
-        # Set UG
-        C_matrix = T.set_subtensor(C_matrix[0:length_of_CG,
-                                   length_of_CG + length_of_CGI:length_of_CG + length_of_CGI + length_of_U_I],
-                                   U_G)
-        # Set FG. I cannot use -index because when is -0 is equivalent to 0
-        C_matrix = T.set_subtensor(
-            C_matrix[0:length_of_CG, length_of_CG + length_of_CGI + length_of_U_I:],
-            F_G.T)
-        # Second row of matrices
-        # Set C_IG
-        C_matrix = T.set_subtensor(
-            C_matrix[length_of_CG:length_of_CG + length_of_CGI, 0:length_of_CG],
-            C_GI)
-        # Set C_I
-        C_matrix = T.set_subtensor(
-            C_matrix[length_of_CG:length_of_CG + length_of_CGI,
-            length_of_CG:length_of_CG + length_of_CGI], C_I)
-        # Set U_I
-        # if not self.u_grade_T.get_value() == 0:
-        C_matrix = T.set_subtensor(
-            C_matrix[length_of_CG:length_of_CG + length_of_CGI,
-            length_of_CG + length_of_CGI:length_of_CG + length_of_CGI + length_of_U_I],
-            U_I)
-        # Set F_I
-        C_matrix = T.set_subtensor(
-            C_matrix[length_of_CG:length_of_CG + length_of_CGI,
-            length_of_CG + length_of_CGI + length_of_U_I:], F_I.T)
-        # Third row of matrices
-        # Set U_G
-        C_matrix = T.set_subtensor(
-            C_matrix[
-            length_of_CG + length_of_CGI:length_of_CG + length_of_CGI + length_of_U_I,
-            0:length_of_CG], U_G.T)
-        # Set U_I
-        C_matrix = T.set_subtensor(C_matrix[
-                                   length_of_CG + length_of_CGI:length_of_CG + length_of_CGI + length_of_U_I,
-                                   length_of_CG:length_of_CG + length_of_CGI], U_I.T)
-        # Fourth row of matrices
-        # Set F_G
-        C_matrix = T.set_subtensor(
-            C_matrix[length_of_CG + length_of_CGI + length_of_U_I:, 0:length_of_CG],
-            F_G)
-        # Set F_I
-        C_matrix = T.set_subtensor(
-            C_matrix[length_of_CG + length_of_CGI + length_of_U_I:,
-            length_of_CG:length_of_CG + length_of_CGI], F_I)
+        # The drift terms do not covary among them
+        length_of_drift = length_of_U_I + length_of_faults
+
+        # Every row of blocks is joined horizontally and then the rows are stacked vertically
+        C_matrix = T.concatenate((
+            T.concatenate((C_G, C_GI.T, U_G, F_G.T), axis=1),
+            T.concatenate((C_GI, C_I, U_I, F_I.T), axis=1),
+            T.concatenate((U_G.T, U_I.T, T.zeros((length_of_U_I, length_of_drift))), axis=1),
+            T.concatenate((F_G, F_I, T.zeros((length_of_faults, length_of_drift))), axis=1),
+        ), axis=0)
+
         # Add name to the theano node
         C_matrix.name = 'Block Covariance Matrix'
-        if str(sys._getframe().f_code.co_name) in self.verbose:
+        if 'covariance_matrix' in self.verbose:
             C_matrix = theano.printing.Print('cov_function')(C_matrix)
 
         return C_matrix
@@ -1353,9 +1290,13 @@ class TheanoGraphPro(object):
         # =====================
         # Creation of the gradients G vector
         # Calculation of the cartesian components of the dips assuming the unit module
-        G_x = T.sin(T.deg2rad(dip_angles)) * T.sin(T.deg2rad(azimuth)) * polarity
-        G_y = T.sin(T.deg2rad(dip_angles)) * T.cos(T.deg2rad(azimuth)) * polarity
-        G_z = T.cos(T.deg2rad(dip_angles)) * polarity
+        dip_angles_rad = T.deg2rad(dip_angles)
+        azimuth_rad = T.deg2rad(azimuth)
+        sin_dip_polarity = T.sin(dip_angles_rad) * polarity
+
+        G_x = sin_dip_polarity * T.sin(azimuth_rad)
+        G_y = sin_dip_polarity * T.cos(azimuth_rad)
+        G_z = T.cos(dip_angles_rad) * polarity
 
         G = T.concatenate((G_x, G_y, G_z))
 
@@ -1363,7 +1304,7 @@ class TheanoGraphPro(object):
         b = T.zeros((length_of_C,))
         b = T.set_subtensor(b[0:G.shape[0]], G)
 
-        if str(sys._getframe().f_code.co_name) in self.verbose:
+        if 'b_vector' in self.verbose:
             b = theano.printing.Print('b vector')(b)
 
         # Add name to the theano node
@@ -1372,8 +1313,9 @@ class TheanoGraphPro(object):
 
     def solve_kriging(self, b=None):
         """
-        Solve the kriging system. This has to get substituted by a more efficient and stable method QR
-        decomposition in all likelihood
+        Solve the kriging system. On cpu and with the cholesky option the covariances are factorized by Cholesky and
+        the drift is solved by its Schur complement. If the covariances are not numerically positive definite the
+        whole system is solved by the general solve instead
 
         Returns:
             theano.tensor.vector: Dual kriging parameters
@@ -1384,7 +1326,7 @@ class TheanoGraphPro(object):
             b = self.b_vector()
             # b = theano.printing.Print('b')(b)
         if self.sparse_version is True:
-            b2 = T.tile(b, (1, 1)).T
+            b2 = b.dimshuffle(0, 'x')
 
             C_sparse = sparse.csr_from_dense(C_matrix)
             b_sparse = sparse.csr_from_dense(b2)
@@ -1394,20 +1336,49 @@ class TheanoGraphPro(object):
         # Solving the kriging system
         elif self.device == 'cuda' and SKCUDA_IMPORT is True:
             import theano.gpuarray.linalg
-            b2 = T.tile(b, (1, 1)).T
+            b2 = b.dimshuffle(0, 'x')
             DK_parameters = theano.gpuarray.linalg.gpu_solve(C_matrix, b2)
 
         else:
             import theano.tensor.slinalg
 
-            DK_parameters = theano.tensor.slinalg.solve(C_matrix, b)
+            if self.cholesky is True:
+                # The covariance block is symmetric positive definite while the drift block is null, so the system is
+                # solved by the Cholesky factor of the covariances and the Schur complement of the drift
+                length_of_CG, length_of_CGI = self.matrices_shapes()[:2]
+                length_of_cov = length_of_CG + length_of_CGI
+
+                C_cov = C_matrix[:length_of_cov, :length_of_cov]
+                C_drift = C_matrix[:length_of_cov, length_of_cov:]
+
+                # The factor is nan if the covariances are not numerically positive definite. The identity is
+                # factorized instead so the triangular solves stay finite and the general solve is used below
+                L = theano.tensor.slinalg.Cholesky(on_error='nan')(C_cov)
+                cholesky_failed = T.any(T.isnan(L))
+                L = T.switch(cholesky_failed, T.eye(length_of_cov), L)
+
+                cov_inv_drift = theano.tensor.slinalg.solve_upper_triangular(
+                    L.T, theano.tensor.slinalg.solve_lower_triangular(L, C_drift))
+                cov_inv_b = theano.tensor.slinalg.solve_upper_triangular(
+                    L.T, theano.tensor.slinalg.solve_lower_triangular(L, b[:length_of_cov]))
+
+                schur_complement = T.dot(C_drift.T, cov_inv_drift)
+                drift_parameters = theano.tensor.slinalg.solve(
+                    schur_complement, T.dot(C_drift.T, cov_inv_b) - b[length_of_cov:])
+
+                DK_parameters = tif.ifelse(
+                    cholesky_failed,
+                    theano.tensor.slinalg.solve(C_matrix, b),
+                    T.concatenate((cov_inv_b - T.dot(cov_inv_drift, drift_parameters), drift_parameters)))
+            else:
+                DK_parameters = theano.tensor.slinalg.solve(C_matrix, b)
 
         DK_parameters = DK_parameters.reshape((DK_parameters.shape[0],))
 
         # Add name to the theano node
         DK_parameters.name = 'Dual Kriging parameters'
 
-        if str(sys._getframe().f_code.co_name) in self.verbose:
+        if 'solve_kriging' in self.verbose:
             DK_parameters = theano.printing.Print(DK_parameters.name)(DK_parameters)
         return DK_parameters
 
@@ -1429,7 +1400,7 @@ class TheanoGraphPro(object):
 
         if verbose > 1:
             theano.printing.pydotprint(grid_val,
-                                       outfile="graphs/" + sys._getframe().f_code.co_name + ".png",
+                                       outfile="graphs/x_to_interpolate.png",
                                        var_with_name_simple=True)
 
         if 'grid_val' in self.verbose:
@@ -1437,23 +1408,6 @@ class TheanoGraphPro(object):
 
         return grid_val
 
-    def extend_dual_kriging(self, weights, grid_shape):
-        # TODO Think what object is worth to save to speed up computation
-        """
-        Tile the dual kriging vector to cover all the points to interpolate.So far I just make a matrix with the
-        dimensions len(DK)x(grid) but in the future maybe I have to try to loop all this part so consume less memory
-
-        Returns:
-            theano.tensor.matrix: Matrix with the Dk parameters repeated for all the points to interpolate
-        """
-        DK_parameters = weights
-        # Creation of a matrix of dimensions equal to the grid with the weights for every point (big 4D matrix in
-        # ravel form)
-        # TODO IMP: Change the tile by a simple dot op -> The DOT version in gpu is slower
-        DK_weights = T.tile(DK_parameters, (grid_shape, 1)).T
-
-        return DK_weights
-
     # endregion
 
     # region Evaluate Geology
@@ -1465,7 +1419,7 @@ class TheanoGraphPro(object):
             theano.tensor.vector: Contribution of all foliations (input) at every point to interpolate
         """
         if weights is None:
-            weights = self.extend_dual_kriging()
+            weights = self.compute_weights()
         if grid_val is None:
             grid_val = self.x_to_interpolate()
 
@@ -1481,41 +1435,29 @@ class TheanoGraphPro(object):
                 (grid_val[:, 2].shape[0], 1))).T
         )
 
-        # Euclidian distances
-        sed_dips_SimPoint = self.squared_euclidean_distances(
-            self.dips_position_tiled, grid_val)
+        # Euclidian distances. They do not depend on the direction, so they are computed for the dips only
+        sed_dips_SimPoint = self.squared_euclidean_distances(self.dips_position, grid_val)
+
+        # First derivative of the covariance, tiled to every direction
+        first_derivative = T.tile(-self.cov_first_derivative(sed_dips_SimPoint), (self.n_dimensions, 1))
 
         if self.sparse_version is True:
             cov_aux = sparse.csr_from_dense(
                 self.gi_reescale *
-                (-hu_SimPoint *
-                 (sed_dips_SimPoint < self.a_T_scalar) *  # first derivative
-                 (- self.c_o_T_scalar * ((
-                                                 -14 / self.a_T_scalar ** 2) + 105 / 4 * sed_dips_SimPoint / self.a_T_scalar ** 3 -
-                                         35 / 2 * sed_dips_SimPoint ** 3 / self.a_T_scalar ** 5 +
-                                         21 / 4 * sed_dips_SimPoint ** 5 / self.a_T_scalar ** 7))))
+                (-hu_SimPoint * first_derivative))
 
-            sliced_weights = weights[
-                             0:length_of_CG]  # T.stack([weights[0, 0:length_of_CG]])#weights[0:length_of_CG]
-            sigma_0_grad = sparse.dot(sliced_weights, cov_aux)
+            sliced_weights = weights[0:length_of_CG]
+            sigma_0_grad = sparse.dot(sliced_weights.dimshuffle('x', 0), cov_aux)[0]
 
         else:
             # Gradient contribution
-            sigma_0_grad = T.sum(
-                (weights[:length_of_CG] *
-                 self.gi_reescale *
-                 (-hu_SimPoint *
-                  (sed_dips_SimPoint < self.a_T_scalar) *  # first derivative
-                  (- self.c_o_T_scalar * ((
-                                                  -14 / self.a_T_scalar ** 2) + 105 / 4 * sed_dips_SimPoint / self.a_T_scalar ** 3 -
-                                          35 / 2 * sed_dips_SimPoint ** 3 / self.a_T_scalar ** 5 +
-                                          21 / 4 * sed_dips_SimPoint ** 5 / self.a_T_scalar ** 7)))),
-                axis=0)
+            sigma_0_grad = T.dot(weights[:length_of_CG] * self.gi_reescale,
+                                 -hu_SimPoint * first_derivative)
 
         # Add name to the theano node
         sigma_0_grad.name = 'Contribution of the foliations to the potential field at every point of the grid'
 
-        if str(sys._getframe().f_code.co_name) in self.verbose:
+        if 'contribution_gradient_interface' in self.verbose:
             sigma_0_grad = theano.printing.Print('interface_gradient_contribution')(
                 sigma_0_grad)
 
@@ -1534,51 +1476,31 @@ class TheanoGraphPro(object):
 
         length_of_CG, length_of_CGI = self.matrices_shapes()[:2]
 
-        # Euclidian distances
-        sed_rest_SimPoint = self.squared_euclidean_distances(self.rest_layer_points,
-                                                             grid_val)
-        sed_ref_SimPoint = self.squared_euclidean_distances(self.ref_layer_points,
-                                                            grid_val)
+        # Euclidian distances. Rest and reference points are stacked so the grid is only read once and the
+        # covariance polynomial is evaluated in a single pass
+        n_rest = self.rest_layer_points.shape[0]
+        rest_ref = T.concatenate([self.rest_layer_points, self.ref_layer_points], axis=0)
+        cov_rest_ref_SimPoint = self.cov_function(self.squared_euclidean_distances(rest_ref, grid_val))
+
+        # SimPoint - Rest Covariances Matrix minus SimPoint - Ref Covariances Matrix
+        cov_interface_SimPoint = cov_rest_ref_SimPoint[:n_rest] - cov_rest_ref_SimPoint[n_rest:]
 
         if self.sparse_version is True:
-            cov_aux = sparse.csr_from_dense(self.c_o_T_scalar * self.i_reescale * (
-                    (
-                            sed_rest_SimPoint < self.a_T_scalar) *  # SimPoint - Rest Covariances Matrix
-                    (1 - 7 * (sed_rest_SimPoint / self.a_T_scalar) ** 2 +
-                     35 / 4 * (sed_rest_SimPoint / self.a_T_scalar) ** 3 -
-                     7 / 2 * (sed_rest_SimPoint / self.a_T_scalar) ** 5 +
-                     3 / 4 * (sed_rest_SimPoint / self.a_T_scalar) ** 7) -
-                    ((sed_ref_SimPoint < self.a_T_scalar) *  # SimPoint- Ref
-                     (1 - 7 * (sed_ref_SimPoint / self.a_T_scalar) ** 2 +
-                      35 / 4 * (sed_ref_SimPoint / self.a_T_scalar) ** 3 -
-                      7 / 2 * (sed_ref_SimPoint / self.a_T_scalar) ** 5 +
-                      3 / 4 * (sed_ref_SimPoint / self.a_T_scalar) ** 7))))
+            cov_aux = sparse.csr_from_dense(self.c_o_T_scalar * self.i_reescale * cov_interface_SimPoint)
 
             weights_sliced = -weights[length_of_CG:length_of_CG + length_of_CGI]
 
-            sigma_0_interf = sparse.dot(weights_sliced, cov_aux)
+            sigma_0_interf = sparse.dot(weights_sliced.dimshuffle('x', 0), cov_aux)[0]
 
         else:
             # Interface contribution
-            sigma_0_interf = (T.sum(
-                -weights[length_of_CG:length_of_CG + length_of_CGI, :] *
-                (self.c_o_T_scalar * self.i_reescale * (
-                        (
-                                sed_rest_SimPoint < self.a_T_scalar) *  # SimPoint - Rest Covariances Matrix
-                        (1 - 7 * (sed_rest_SimPoint / self.a_T_scalar) ** 2 +
-                         35 / 4 * (sed_rest_SimPoint / self.a_T_scalar) ** 3 -
-                         7 / 2 * (sed_rest_SimPoint / self.a_T_scalar) ** 5 +
-                         3 / 4 * (sed_rest_SimPoint / self.a_T_scalar) ** 7) -
-                        ((sed_ref_SimPoint < self.a_T_scalar) *  # SimPoint- Ref
-                         (1 - 7 * (sed_ref_SimPoint / self.a_T_scalar) ** 2 +
-                          35 / 4 * (sed_ref_SimPoint / self.a_T_scalar) ** 3 -
-                          7 / 2 * (sed_ref_SimPoint / self.a_T_scalar) ** 5 +
-                          3 / 4 * (sed_ref_SimPoint / self.a_T_scalar) ** 7)))),
-                axis=0))
+            sigma_0_interf = T.dot(
+                -weights[length_of_CG:length_of_CG + length_of_CGI] * self.c_o_T_scalar * self.i_reescale,
+                cov_interface_SimPoint)
         # Add name to the theano node
         sigma_0_interf.name = 'Contribution of the surface_points to the potential field at every point of the grid'
 
-        if str(sys._getframe().f_code.co_name) in self.verbose:
+        if 'contribution_interface' in self.verbose:
             sigma_0_interf = theano.printing.Print('interface_contribution')(
                 sigma_0_interf)
 
@@ -1597,37 +1519,30 @@ class TheanoGraphPro(object):
 
         length_of_CG, length_of_CGI, length_of_U_I, length_of_faults, length_of_C = self.matrices_shapes()
 
-        universal_grid_surface_points_matrix = T.horizontal_stack(
-            grid_val,
-            (grid_val ** 2),
-            T.stack((grid_val[:, 0] * grid_val[:, 1],
-                     grid_val[:, 0] * grid_val[:, 2],
-                     grid_val[:, 1] * grid_val[:, 2]), axis=1)).T
+        # Drift terms at every point to interpolate, one row per term so the rows used are contiguous. The
+        # quadratic terms are only built when the series uses the second degree drift
+        universal_grid_surface_points_matrix = tif.ifelse(
+            T.le(self.n_universal_eq_T_op, 3),
+            grid_val.T,
+            T.concatenate((
+                grid_val.T,
+                (grid_val ** 2).T,
+                T.stack((grid_val[:, 0] * grid_val[:, 1],
+                         grid_val[:, 0] * grid_val[:, 2],
+                         grid_val[:, 1] * grid_val[:, 2]), axis=0)), axis=0))
 
         i_rescale_aux = T.tile(self.gi_reescale, 9)
         i_rescale_aux = T.set_subtensor(i_rescale_aux[:3], 1)
-        _aux_magic_term = T.tile(i_rescale_aux[:self.n_universal_eq_T_op],
-                                 (grid_val.shape[0], 1)).T
-
-        if self.sparse_version is True:  # self.dot_version:
-            f_0 = T.dot(
-                weights[
-                length_of_CG + length_of_CGI:length_of_CG + length_of_CGI + length_of_U_I],
-                (self.gi_reescale * _aux_magic_term *
-                 universal_grid_surface_points_matrix[:self.n_universal_eq_T_op]))
-        else:
-            # Drif contribution
-            f_0 = (T.sum(
-                weights[
-                length_of_CG + length_of_CGI:length_of_CG + length_of_CGI + length_of_U_I] * self.gi_reescale *
-                _aux_magic_term *
-                universal_grid_surface_points_matrix[:self.n_universal_eq_T_op]
-                , axis=0))
+
+        # The rescaling is folded into the drift weights so the contribution is a single dot with the drift terms
+        weights_drift = weights[length_of_CG + length_of_CGI:length_of_CG + length_of_CGI + length_of_U_I]
+        f_0 = T.dot(weights_drift * self.gi_reescale * i_rescale_aux[:self.n_universal_eq_T_op],
+                    universal_grid_surface_points_matrix[:self.n_universal_eq_T_op])
 
         if not type(f_0) == int:
             f_0.name = 'Contribution of the universal drift to the potential field at every point of the grid'
 
-        if str(sys._getframe().f_code.co_name) in self.verbose:
+        if 'contribution_universal_drift' in self.verbose:
             f_0 = theano.printing.Print('Universal terms contribution')(f_0)
 
         return f_0
@@ -1646,51 +1561,26 @@ class TheanoGraphPro(object):
 
         fault_matrix_selection_non_zero = f_m[:, a:b]
 
-        if self.sparse_version is True:  # self.dot_version:
-            f_1 = T.dot(
-                weights[length_of_CG + length_of_CGI + length_of_U_I:], (
-                    fault_matrix_selection_non_zero))
-        else:
-            f_1 = T.sum(
-                weights[length_of_CG + length_of_CGI + length_of_U_I:,
-                :] * fault_matrix_selection_non_zero, axis=0)
+        f_1 = T.dot(weights[length_of_CG + length_of_CGI + length_of_U_I:], fault_matrix_selection_non_zero)
 
         # Add name to the theano node
         f_1.name = 'Faults contribution'
 
-        if str(sys._getframe().f_code.co_name) in self.verbose:
+        if 'contribution_faults' in self.verbose:
             f_1 = theano.printing.Print('Faults contribution')(f_1)
 
         return f_1
 
     def scalar_field_loop(self, a, b, Z_x, grid_val, weights, fault_matrix):
 
-        if self.sparse_version is True:
-            rang = 5
-            tiled_weights = self.extend_dual_kriging(weights, rang)
-            sigma_0_grad = self.contribution_gradient_interface(grid_val[a:b],
-                                                                tiled_weights)
-            sigma_0_interf = self.contribution_interface(grid_val[a:b],
-                                                         tiled_weights)
-            f_0 = self.contribution_universal_drift(grid_val[a:b], tiled_weights)
-            f_1 = self.contribution_faults(tiled_weights, a, b)
-
-            # Add an arbitrary number at the potential field to get unique values for each of them
-            partial_Z_x = (sigma_0_grad + sigma_0_interf + f_0 + f_1)[0]
+        # Every contribution is the dot of its slice of the weights with its covariances at the grid
+        sigma_0_grad = self.contribution_gradient_interface(grid_val[a:b], weights)
+        sigma_0_interf = self.contribution_interface(grid_val[a:b], weights)
+        f_0 = self.contribution_universal_drift(grid_val[a:b], weights)
+        f_1 = self.contribution_faults(weights, a, b, fault_matrix)
 
-        else:
-            rang = b - a
-            tiled_weights = self.extend_dual_kriging(weights, rang)
-            sigma_0_grad = self.contribution_gradient_interface(grid_val[a:b],
-                                                                tiled_weights[:, :])
-            sigma_0_interf = self.contribution_interface(grid_val[a:b],
-                                                         tiled_weights[:, :])
-            f_0 = self.contribution_universal_drift(grid_val[a:b],
-                                                    tiled_weights[:, :])
-            f_1 = self.contribution_faults(tiled_weights[:, :], a, b, fault_matrix)
-
-            # Add an arbitrary number at the potential field to get unique values for each of them
-            partial_Z_x = (sigma_0_grad + sigma_0_interf + f_0 + f_1)
+        # Add an arbitrary number at the potential field to get unique values for each of them
+        partial_Z_x = (sigma_0_grad + sigma_0_interf + f_0 + f_1)
 
         Z_x = T.set_subtensor(Z_x[a:b], partial_Z_x)
 
@@ -1710,8 +1600,9 @@ class TheanoGraphPro(object):
         if 'grid_shape' in self.verbose:
             grid_shape = theano.printing.Print('grid_shape')(grid_shape)
 
-        # If memory errors reduce this to 11
-        steps = 5e6 / self.matrices_shapes()[-1]  # / grid_shape
+        # If memory errors reduce this to 11. The chunk size is cast to an integer
+        # number of points so every chunk but the last one has the same length
+        steps = T.cast(T.maximum(T.floor(5e6 / self.matrices_shapes()[-1]), 1), 'int64')
         if 'steps' in self.verbose:
             steps = theano.printing.Print('steps')(steps)
 
@@ -1724,10 +1615,9 @@ class TheanoGraphPro(object):
         # Check if we loop the grid or not
         if self.sparse_version is True:
             self.dot_version = True
-            Z_x = self.scalar_field_loop(0, 100000000, Z_x_init, grid_val, weights)
+            Z_x = self.scalar_field_loop(0, 100000000, Z_x_init, grid_val, weights, fault_matrix)
 
         elif self.max_speed < 2:
-            # tiled_weights = self.extend_dual_kriging(weights, grid_val.shape[0])
             Z_x_loop, updates3 = theano.scan(
                 fn=self.scalar_field_loop,
                 outputs_info=[Z_x_init],
@@ -1739,13 +1629,12 @@ class TheanoGraphPro(object):
 
             Z_x = Z_x_loop[-1][-1]
         else:
-            tiled_weights = self.extend_dual_kriging(weights, grid_val.shape[0])
-            Z_x = self.scalar_field_loop(0, 100000000, Z_x_init, grid_val,
-                                         tiled_weights)
+            Z_x = self.scalar_field_loop(0, 100000000, Z_x_init, grid_val, weights,
+                                         fault_matrix)
 
         Z_x.name = 'Value of the potential field at every point'
 
-        if str(sys._getframe().f_code.co_name) in self.verbose:
+        if 'scalar_field_at_all' in self.verbose:
             Z_x = theano.printing.Print('Potential field at all points')(Z_x)
 
         return Z_x
@@ -1792,38 +1681,41 @@ class TheanoGraphPro(object):
 
         return ellipse_factor
 
-    def compare(self, a, b, slice_init, Z_x, l, n_surface, drift):
+    def compare(self, a, b, Z_x, l, n_surface, drift):
         """
-        Treshold of the points to interpolate given 2 potential field values. TODO: This function is the one we
-        need to change for a sigmoid function
+        Treshold of the points to interpolate given the potential field values limiting every surface. All the
+        surfaces are segmented at once by broadcasting, with the axes surfaces x properties x points to interpolate
 
         Args:
-            a (scalar): Upper limit of the potential field
-            b (scalar): Lower limit of the potential field
-            n_surface (scalar): Value given to the segmentation, i.e. lithology number
+            a (vector): Upper limits of the potential field of every surface
+            b (vector): Lower limits of the potential field of every surface
             Zx (vector): Potential field values at all the interpolated points
+            l (scalar or vector): Slope of the sigmoid
+            n_surface (matrix): Values given to the segmentation, i.e. lithology number, repeated twice per
+             surface
+            drift (matrix): Values added to the segmentation, repeated twice per surface
 
         Returns:
-            theano.tensor.vector: segmented values
+            theano.tensor.tensor3: segmented values of every surface
         """
 
-        slice_init = slice_init
-        n_surface_0 = n_surface[:, slice_init:slice_init + 1]
-        n_surface_1 = n_surface[:, slice_init + 1:slice_init + 2]
-        drift = drift[:, slice_init:slice_init + 1]
+        a = a.dimshuffle(0, 'x', 'x')
+        b = b.dimshuffle(0, 'x', 'x')
+        n_surface_0 = n_surface[:, ::2].T.dimshuffle(0, 1, 'x')
+        n_surface_1 = n_surface[:, 1::2].T.dimshuffle(0, 1, 'x')
+        drift = drift[:, ::2].T.dimshuffle(0, 1, 'x')
+        Z_x = Z_x.dimshuffle('x', 'x', 0)
 
         if 'compare' in self.verbose:
             a = theano.printing.Print("a")(a)
             b = theano.printing.Print("b")(b)
-            # l = 200/ (a - b)
-            slice_init = theano.printing.Print("slice_init")(slice_init)
             n_surface_0 = theano.printing.Print("n_surface_0")(n_surface_0)
             n_surface_1 = theano.printing.Print("n_surface_1")(n_surface_1)
-            drift = theano.printing.Print("drift[slice_init:slice_init+1][0]")(drift)
+            drift = theano.printing.Print("drift")(drift)
 
         # The 5 rules the slope of the function
-        sigm =  (-n_surface_0.reshape((-1, 1)) / (1 + T.exp(-l * (Z_x - a)))) \
-               - (n_surface_1.reshape((-1, 1)) / (1 + T.exp(l * (Z_x - b)))) + drift.reshape((-1, 1))
+        sigm = (-n_surface_0 / (1 + T.exp(-l * (Z_x - a)))) \
+               - (n_surface_1 / (1 + T.exp(l * (Z_x - b)))) + drift
         if 'sigma' in self.verbose:
             sigm = theano.printing.Print("middle point")(sigm)
         return sigm
@@ -1900,7 +1792,7 @@ class TheanoGraphPro(object):
         # Here we just take the first element of values properties because at least so far we do not find a reason
         # to populate fault blocks with anything else
 
-        n_surface_op_float_sigmoid = T.repeat(values_properties_op[[0], :], 2,
+        n_surface_op_float_sigmoid = T.repeat(values_properties_op[:1, :], 2,
                                               axis=1)
 
         # TODO: instead -1 at the border look for the average distance of the input!
@@ -1921,23 +1813,15 @@ class TheanoGraphPro(object):
                 "n_surface_op_float_sigmoid") \
                 (n_surface_op_float_sigmoid)
 
-        fault_block, updates2 = theano.scan(
-            fn=self.compare,
-            outputs_info=None,
-            sequences=[dict(input=scalar_field_iter, taps=[0, 1]),
-                       T.arange(0, n_surface_op_float_sigmoid.shape[1], 2,
-                                dtype='int64')],
-            non_sequences=[Z_x, sigmoid_slope, n_surface_op_float_sigmoid, drift],
-            name='Looping compare',
-            profile=False,
-            return_list=False)
+        fault_block = self.compare(scalar_field_iter[:-1], scalar_field_iter[1:], Z_x, sigmoid_slope,
+                                   n_surface_op_float_sigmoid, drift)
 
         # For every surface we get a vector so we need to sum compress them to one dimension
         fault_block = fault_block.sum(axis=0)
 
         # Add name to the theano node
         fault_block.name = 'The chunk of block model of a specific series'
-        if str(sys._getframe().f_code.co_name) in self.verbose:
+        if 'export_fault_block' in self.verbose:
             fault_block = theano.printing.Print(fault_block.name)(fault_block)
 
         return fault_block
@@ -1984,7 +1868,7 @@ class TheanoGraphPro(object):
             scalar_field_iter = theano.printing.Print("scalar_field_iter")(
                 scalar_field_iter)
 
-        # Loop to segment the distinct lithologies
+        # Segment the distinct lithologies
 
         n_surface_op_float_sigmoid = T.repeat(values_properties_op, 2, axis=1)
         n_surface_op_float_sigmoid = T.set_subtensor(
@@ -1999,16 +1883,8 @@ class TheanoGraphPro(object):
                 "n_surface_op_float_sigmoid") \
                 (n_surface_op_float_sigmoid)
 
-        formations_block, updates2 = theano.scan(
-            fn=self.compare,
-            outputs_info=None,
-            sequences=[dict(input=scalar_field_iter, taps=[0, 1]),
-                       T.arange(0, n_surface_op_float_sigmoid.shape[1], 2,
-                                dtype='int64')],
-            non_sequences=[Z_x, l, n_surface_op_float_sigmoid, drift],
-            name='Looping compare',
-            profile=False,
-            return_list=False)
+        formations_block = self.compare(scalar_field_iter[:-1], scalar_field_iter[1:], Z_x, l,
+                                        n_surface_op_float_sigmoid, drift)
 
         # For every surface we get a vector so we need to sum compress them to one dimension
         formations_block = formations_block.sum(axis=0)
@@ -2027,7 +1903,7 @@ class TheanoGraphPro(object):
 
         # Add name to the theano node
         formations_block.name = 'The chunk of block model of a specific series'
-        if str(sys._getframe().f_code.co_name) in self.verbose:
+        if 'export_formation_block' in self.verbose:
             formations_block = theano.printing.Print(formations_block.name)(
                 formations_block)
 
@@ -2079,7 +1955,6 @@ class TheanoGraphPro(object):
         n_surface_op = self.n_surface[n_form_per_serie_0: n_form_per_serie_1]
 
         self.dips_position = self.dips_position_all[len_f_0: len_f_1, :]
-        self.dips_position_tiled = T.tile(self.dips_position, (self.n_dimensions, 1))
 
         self.dip_angles = self.dip_angles_all[len_f_0: len_f_1]
 
@@ -2126,10 +2001,9 @@ class TheanoGraphPro(object):
                                                   :, interface_loc + len_i_0:
                                                      interface_loc + len_i_1]
 
-        self.fault_drift_at_surface_points_ref = fault_matrix_op[
-                                                 :,
-                                                 interface_loc + self.len_points + len_i_0:
-                                                 interface_loc + self.len_points + len_i_1]
+        # The reference points follow the rest points in the points to interpolate
+        ref_loc = interface_loc + self.len_points
+        self.fault_drift_at_surface_points_ref = fault_matrix_op[:, ref_loc + len_i_0: ref_loc + len_i_1]
 
         b = self.b_vector(self.dip_angles, self.azimuth, self.polarity)
 
@@ -2196,6 +2070,9 @@ class TheanoGraphPro(object):
                             T.gt(Z_x, T.min(scalar_field_at_surface_points)),
                             T.zeros_like(Z_x, dtype='bool'))
 
+        # Values of the surfaces of this series plus the one below, sliced once for all the block exports
+        values_properties_series = self.values_properties_op[:, n_form_per_serie_0: n_form_per_serie_1 + 1]
+
         if self.gradient is False:
             block = tif.ifelse(
                 compute_block_ctr,
@@ -2203,14 +2080,12 @@ class TheanoGraphPro(object):
                     is_finite,
                     self.compute_fault_block(
                         Z_x, scalar_field_at_surface_points,
-                        self.values_properties_op[:,
-                        n_form_per_serie_0: n_form_per_serie_1 + 1],
+                        values_properties_series,
                         n_series, grid
                     ),
                     self.compute_formation_block(
                         Z_x, scalar_field_at_surface_points,
-                        self.values_properties_op[:,
-                        n_form_per_serie_0: n_form_per_serie_1 + 1])
+                        values_properties_series)
                 ),
                 block_matrix[n_series, :]
             )
@@ -2218,8 +2093,7 @@ class TheanoGraphPro(object):
             block = tif.ifelse(compute_block_ctr,
                                self.compute_formation_block(
                                    Z_x, scalar_field_at_surface_points,
-                                   self.values_properties_op[:,
-                                   n_form_per_serie_0: n_form_per_serie_1 + 1]),
+                                   values_properties_series),
                                block_matrix[n_series, :]
                                )
 
@@ -2293,10 +2167,9 @@ class TheanoGraphPro(object):
         if 'grav_devices' in self.verbose:
             n_devices = theano.printing.Print('n_devices')(n_devices)
 
-        tz_rep = T.tile(self.tz, n_devices)
-
-        # density times the component z of gravity
-        grav = (densities * tz_rep).reshape((n_devices, -1)).sum(axis=1)
+        # density times the component z of gravity. One row per device, so tz does
+        # not need to be tiled n_devices times
+        grav = T.dot(densities.reshape((n_devices, -1)), self.tz)
 
         return final_model, new_block, new_weights, new_scalar, new_sfai, new_mask, grav  # , model_sol.append(grav)
 
@@ -2310,10 +2183,9 @@ class TheanoGraphPro(object):
         if 'grav_devices' in self.verbose:
             n_devices = theano.printing.Print('n_devices')(n_devices)
 
-        tz_rep = T.tile(self.tz, n_devices)
-
-        # density times the component z of gravity
-        grav = (densities * tz_rep).reshape((n_devices, -1)).sum(axis=1)
+        # density times the component z of gravity. One row per device, so tz does
+        # not need to be tiled n_devices times
+        grav = T.dot(densities.reshape((n_devices, -1)), self.tz)
 
         return grav
 
@@ -2339,8 +2211,13 @@ class TheanoGraphPro(object):
         if 'magnetics' in self.verbose:
             k_vals = theano.printing.Print('Sus. values')(k_vals)
 
-        # get induced magnetisation [T]
-        J = k_vals * self.B_ext  # k_vals contains susceptibility values of each voxel for all devices: [k1dev1,..,kndevn]
+        n_devices = T.cast((k_vals.shape[0] / self.V.shape[1]), dtype='int32')
+        if 'mag_devices' in self.verbose:
+            n_devices = theano.printing.Print('n_devices')(n_devices)
+
+        # get induced magnetisation [T]. k_vals contains susceptibility values of each voxel for all
+        # devices: [k1dev1,..,kndevn] so we reshape it to one row per device and broadcast V against it
+        J = k_vals.reshape((n_devices, -1)) * self.B_ext
 
         # and the components:
         dir_x, dir_y, dir_z = magnetic_direction(self.incl, self.decl)
@@ -2348,22 +2225,18 @@ class TheanoGraphPro(object):
         Jy = dir_y * J
         Jz = dir_z * J
 
-        n_devices = T.cast((k_vals.shape[0] / self.V.shape[1]), dtype='int32')
-        if 'mag_devices' in self.verbose:
-            n_devices = theano.printing.Print('n_devices')(n_devices)
-
-        V = T.tile(self.V, (1, n_devices))  # repeat for each device
+        V = self.V.dimshuffle(0, 'x', 1)
 
         # directional magnetic effect on one voxel (3.19)
-        Tx = (Jx * V[0, :] + Jy * V[1, :] + Jz * V[2, :]) / (4 * self.pi)
-        Ty = (Jx * V[1, :] + Jy * V[3, :] + Jz * V[4, :]) / (4 * self.pi)
-        Tz = (Jx * V[2, :] + Jy * V[4, :] + Jz * V[5, :]) / (4 * self.pi)
+        Tx = (Jx * V[0] + Jy * V[1] + Jz * V[2]) / (4 * self.pi)
+        Ty = (Jx * V[1] + Jy * V[3] + Jz * V[4]) / (4 * self.pi)
+        Tz = (Jx * V[2] + Jy * V[4] + Jz * V[5]) / (4 * self.pi)
 
         T2nT = 1e9  # to get result in [nT] - common for geophysical applications
 
-        Tx = (T.sum(Tx.reshape((n_devices, -1)), axis=1)) * T2nT
-        Ty = (T.sum(Ty.reshape((n_devices, -1)), axis=1)) * T2nT
-        Tz = (T.sum(Tz.reshape((n_devices, -1)), axis=1)) * T2nT
+        Tx = T.sum(Tx, axis=1) * T2nT
+        Ty = T.sum(Ty, axis=1) * T2nT
+        Tz = T.sum(Tz, axis=1) * T2nT
 
         # -„Total field magnetometers can measure only that part of the anomalous field which is in the direction of
         # the Earths main field“ (SimPEG documentation)'
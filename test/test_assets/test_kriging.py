@@ -0,0 +1,61 @@
+# Importing auxiliary libraries
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from scipy.spatial.distance import cdist
+
+from gempy.assets import kriging
+
+
+@pytest.fixture(scope='module')
+def kriging_points():
+    rng = np.random.RandomState(1234)
+    data = np.column_stack((rng.uniform(0, 10, (25, 3)), rng.normal(5, 2, 25)))
+    grid = rng.uniform(0, 10, (40, 3))
+    return data, grid
+
+
+@pytest.mark.parametrize('theoretical_model', ['exponential', 'gaussian', 'spherical'])
+def test_kriging_all_matches_point_wise(kriging_points, theoretical_model):
+    data, grid = kriging_points
+    var_mod = kriging.variogram_model(theoretical_model, range_=4, sill=3, nugget=0.1)
+
+    dist_all_to_all = cdist(data[:, :3], data[:, :3])
+    dist_grid_to_all = cdist(grid, data[:, :3])
+    inp_mean = data[:, 3].mean()
+
+    ok_vals, ok_vars = kriging.ordinary_kriging_all(dist_grid_to_all, dist_all_to_all, data[:, 3], var_mod)
+    sk_vals, sk_vars = kriging.simple_kriging_all(dist_grid_to_all, dist_all_to_all, data[:, 3], var_mod,
+                                                  inp_mean)
+
+    for i in range(len(grid)):
+        val, var = kriging.ordinary_kriging(dist_grid_to_all[i], dist_all_to_all, data[:, 3], var_mod)
+        np.testing.assert_allclose([ok_vals[i], ok_vars[i]], [val, var], rtol=1e-7, atol=1e-10)
+
+        val, var = kriging.simple_kriging(dist_grid_to_all[i], dist_all_to_all, data[:, 3], var_mod, inp_mean)
+        np.testing.assert_allclose([sk_vals[i], sk_vars[i]], [val, var], rtol=1e-7, atol=1e-10)
+
+
+def test_simple_kriging_empty_neighbourhood():
+    # no data within range of the target point: the estimate falls back to the mean with the full sill as variance
+    var_mod = kriging.variogram_model('exponential', range_=4, sill=3, nugget=0.1)
+    val, var = kriging.simple_kriging(np.empty(0), np.empty((0, 0)), np.empty(0), var_mod, 5.)
+    np.testing.assert_allclose([val, var], [5., 3.])
+
+
+def test_gaussian_field_simple_kriging_range_without_neighbours(kriging_points):
+    # grid points far away from the data and from each other have no known location within range
+    data, _ = kriging_points
+    domain = SimpleNamespace(coords=data[:, :3], values=data[:, 3], inp_mean=data[:, 3].mean(),
+                             krig_grid=np.array([[100., 100., 100.], [200., 200., 200.], [5., 5., 5.]]))
+    var_mod = kriging.variogram_model('exponential', range_=4, sill=3, nugget=0.1)
+
+    np.random.seed(1234)
+    solution = kriging.create_gaussian_field(domain, var_mod, moving_neighbourhood='range', kriging_type='SK')
+    np.testing.assert_allclose(solution.results['estimation variance'][:2], 3.)
+
+
+def test_variogram_model_unknown_theoretical_model():
+    with pytest.raises(ValueError):
+        kriging.variogram_model('linear')
@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+import theano
+import theano.tensor as T
+
+from gempy.core.theano_modules.theano_graph_pro import TheanoGraphPro
+
+
+def solve_kriging_system(range_, c_o, n_universal_eq, dips_position, surface_points, points_per_surface,
+                         nugget_scalar, nugget_grad, n_faults=0, dtype='float64', **kwargs):
+    """Compile and evaluate the dual kriging parameters of a single series"""
+    graph = TheanoGraphPro(optimizer='fast_compile', dtype=dtype, **kwargs)
+    # Kriging parameters of a single series, as set by compute_a_series
+    graph.a_T_scalar = graph.a_T[0]
+    graph.c_o_T_scalar = graph.c_o_T[0]
+    graph.lenght_of_faults = T.cast(graph.fault_matrix.shape[0], 'int32')
+
+    n_dips = dips_position.shape[0]
+    n_rest = surface_points.shape[0] - len(points_per_surface)
+    rng = np.random.RandomState(1234)
+
+    graph.a_T.set_value(np.full(3, range_, dtype=dtype))
+    graph.c_o_T.set_value(np.full(3, c_o, dtype=dtype))
+    graph.n_universal_eq_T_op.set_value(n_universal_eq)
+    graph.number_of_points_per_surface_T.set_value(np.asarray(points_per_surface, dtype='int32'))
+    graph.nugget_effect_scalar_T.set_value(np.asarray(nugget_scalar, dtype=dtype))
+    graph.nugget_effect_grad_T.set_value(np.asarray(nugget_grad, dtype=dtype))
+
+    inputs = [dips_position, rng.uniform(0, 90, n_dips), rng.uniform(0, 360, n_dips), np.ones(n_dips),
+              surface_points, rng.uniform(0, 1, (n_faults, 2 * n_rest))]
+
+    solve_kriging = theano.function(graph.input_parameters_kriging, graph.solve_kriging(),
+                                    on_unused_input='ignore')
+    return solve_kriging(*[np.asarray(i, dtype=dtype) for i in inputs])
+
+
+@pytest.mark.parametrize('n_faults', [0, 2])
+@pytest.mark.parametrize('n_universal_eq', [0, 3, 9])
+def test_cholesky_solve_matches_general_solve(n_universal_eq, n_faults):
+    rng = np.random.RandomState(1234)
+    points_per_surface = np.array([4, 5, 3])
+    n_surface_points = points_per_surface.sum() + len(points_per_surface)
+    system = dict(range_=0.6, c_o=0.3, n_universal_eq=n_universal_eq, n_faults=n_faults,
+                  dips_position=rng.uniform(0, 1, (6, 3)), surface_points=rng.uniform(0, 1, (n_surface_points, 3)),
+                  points_per_surface=points_per_surface,
+                  nugget_scalar=rng.uniform(1e-3, 1e-2, n_surface_points), nugget_grad=rng.uniform(1e-3, 1e-2, 18))
+
+    np.testing.assert_allclose(solve_kriging_system(cholesky=True, **system),
+                               solve_kriging_system(cholesky=False, **system),
+                               rtol=1e-7, atol=1e-10)
+
+
+@pytest.fixture(scope='module')
+def default_kriging_system():
+    """
+    Three layers of 300 points and 20 dips in a 1000 m cube, with the default range, covariance at 0 and nuggets.
+    In float32 the covariances of such a model are not numerically positive definite
+    """
+    rng = np.random.RandomState(0)
+    extent, n_points, n_dips = 1000, 300, 20
+    rescaling_factor = 2 * extent
+    range_ = np.sqrt(3 * extent ** 2)
+
+    surface_points = np.column_stack((rng.uniform(0.25, 0.75, (3 * n_points, 2)),
+                                      np.repeat([0.4, 0.5, 0.6], n_points) + rng.normal(0, 0.01, 3 * n_points)))
+
+    return dict(range_=range_ / rescaling_factor, c_o=range_ ** 2 / 14 / 3 / rescaling_factor, n_universal_eq=3,
+                dips_position=rng.uniform(0.25, 0.75, (n_dips, 3)), surface_points=surface_points,
+                points_per_surface=np.full(3, n_points - 1),
+                nugget_scalar=np.full(3 * n_points, 2e-6), nugget_grad=np.full(3 * n_dips, 0.01))
+
+
+@pytest.mark.parametrize('dtype', ['float32', 'float64'])
+def test_default_solve_of_default_kriging_parameters(default_kriging_system, dtype):
+    DK_parameters = solve_kriging_system(dtype=dtype, **default_kriging_system)
+    assert np.all(np.isfinite(DK_parameters))
+
+    np.testing.assert_allclose(DK_parameters,
+                               solve_kriging_system(dtype=dtype, cholesky=False, **default_kriging_system),
+                               rtol=1e-7, atol=1e-6 * np.abs(DK_parameters).max())
+
+
+def test_cholesky_falls_back_to_general_solve(default_kriging_system):
+    DK_parameters = solve_kriging_system(dtype='float32', cholesky=True, **default_kriging_system)
+    assert np.all(np.isfinite(DK_parameters))